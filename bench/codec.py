@@ -0,0 +1,135 @@
+"""Microbenchmark: compiled per-class codecs vs. per-key field dispatch.
+
+The "generic" functions below reproduce the conversion path used before
+document classes carried a _Codec: every key is resolved through
+_Attributes.get_fieldtype and get_dbname, and every value goes through
+Field.to_mongo's dispatch on the context string.
+
+Usage: python bench/codec.py [iterations]
+"""
+import datetime
+import sys
+import timeit
+
+import pymongo.objectid
+from vultan.document import Document, Key
+from vultan.types import (BoolField, DatetimeField, FloatField, IntField,
+                          ListField, ObjectIdListField, StringField)
+
+
+class Wide(Document):
+    _collection = 'bench_wide'
+    _keys = [Key('name')]
+    _attributes = {
+        'name': StringField(),
+        'count': IntField().dbname('c'),
+        'ratio': FloatField().dbname('r'),
+        'active': BoolField(),
+        'created': DatetimeField(),
+        'tags': ListField(StringField()),
+        'refs': ObjectIdListField(),
+    }
+
+
+DOC = {
+    'id': str(pymongo.objectid.ObjectId()),
+    'name': u'benchmark',
+    'count': 42,
+    'ratio': 0.5,
+    'active': True,
+    'created': datetime.datetime(2012, 1, 1),
+    'tags': [u'a', u'b', u'c'],
+    'refs': [str(pymongo.objectid.ObjectId()) for _ in range(5)],
+}
+
+QUERY = {'name': u'benchmark', 'count': {'$gte': 1, '$lt': 100},
+         'tags': {'$in': [u'a', u'b']}}
+
+UPDATE = {'$set': {'ratio': 0.75, 'active': False},
+          '$push': {'tags': u'd'}, '$inc': {'count': 1}}
+
+
+def generic_to_mongo(cls, doc, context='AUTO', dotransform=True):
+    answer = {}
+    for key, value in doc.iteritems():
+        fieldtype = cls._get_fieldtype(key)
+        if dotransform:
+            value = fieldtype.to_mongo(value, context)
+        answer[fieldtype.get_dbname(key)] = value
+    return answer
+
+
+def generic_query_to_mongo(cls, doc):
+    def helper(fieldtype, value):
+        if isinstance(value, dict):
+            if all(key.startswith('$') for key in value):
+                dct = {}
+                for op, val in value.iteritems():
+                    if op in ['$gt', '$lt', '$gte', '$lte', '$ne']:
+                        dct[op] = fieldtype.to_mongo(val, 'AUTO')
+                    elif op in ['$in', '$nin']:
+                        dct[op] = fieldtype.to_mongo(val, 'MANY')
+                return dct
+        return fieldtype.to_mongo(value, 'NONE')
+
+    answer = {}
+    for key, value in doc.iteritems():
+        fieldtype = cls._get_fieldtype(key)
+        answer[fieldtype.get_dbname(key)] = helper(fieldtype, value)
+    return answer
+
+
+def generic_update_to_mongo(cls, doc):
+    answer = {}
+    for key, value in doc.iteritems():
+        if key in ['$set', '$unset']:
+            answer[key] = generic_to_mongo(cls, value, 'AUTO')
+        elif key in ['$push', '$pull']:
+            answer[key] = generic_to_mongo(cls, value, 'ATOM')
+        elif key in ['$pushAll', '$pullAll']:
+            answer[key] = generic_to_mongo(cls, value, 'LIST')
+        elif key in ['$inc', '$pop']:
+            answer[key] = generic_to_mongo(cls, value, dotransform=False)
+    return answer
+
+
+def generic_decode(cls, data):
+    return dict((name, fieldtype.from_mongo(data.get(fieldtype.get_dbname(name))))
+                for name, fieldtype in cls._attributes)
+
+
+def compiled_decode(cls, data):
+    return dict((name, decode(data.get(dbname)))
+                for name, dbname, decode in cls._codec.decoders)
+
+
+RAW = Wide._document_to_mongo(DOC)
+
+CASES = [
+    ('encode document',
+     lambda: generic_to_mongo(Wide, DOC),
+     lambda: Wide._document_to_mongo(DOC)),
+    ('encode query',
+     lambda: generic_query_to_mongo(Wide, QUERY),
+     lambda: Wide._query_to_mongo(QUERY)),
+    ('encode update',
+     lambda: generic_update_to_mongo(Wide, UPDATE),
+     lambda: Wide._update_to_mongo(UPDATE)),
+    ('decode document',
+     lambda: generic_decode(Wide, RAW),
+     lambda: compiled_decode(Wide, RAW)),
+]
+
+
+def main(iterations=20000):
+    for name, generic, compiled in CASES:
+        assert generic() == compiled(), name
+        before = min(timeit.repeat(generic, number=iterations, repeat=3))
+        after = min(timeit.repeat(compiled, number=iterations, repeat=3))
+        print '%-16s generic %7.2f us  compiled %7.2f us  (%.2fx)' % (
+            name, 1e6 * before / iterations, 1e6 * after / iterations,
+            before / after)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,96 @@
+"""Memory benchmark: per-instance footprint of plain, slotted, and slotted
+documents that drop their raw data after decoding.
+
+Sizes are the sum of sys.getsizeof over every object an instance owns: the
+instance, its __dict__, its bookkeeping, its raw data dict, and the raw and
+decoded values (including the items of list values), each counted once.
+
+Usage: python bench/memory.py [count]
+"""
+import datetime
+import sys
+
+import pymongo.objectid
+from vultan.new import NewDocument
+from vultan.document import Key
+from vultan.types import (BoolField, DatetimeField, FloatField, IntField,
+                          ListField, StringField)
+
+
+ATTRIBUTES = {
+    'name': StringField(),
+    'count': IntField().dbname('c'),
+    'ratio': FloatField().dbname('r'),
+    'active': BoolField(),
+    'created': DatetimeField(),
+    'tags': ListField(StringField()),
+}
+
+
+class Plain(NewDocument):
+    _keys = [Key('name')]
+    _attributes = dict(ATTRIBUTES)
+
+
+class Slotted(NewDocument):
+    _slots = True
+    _keys = [Key('name')]
+    _attributes = dict(ATTRIBUTES)
+
+
+class SlottedWithoutData(Slotted):
+    _keep_data = False
+
+
+RAW = {
+    '_id': pymongo.objectid.ObjectId(),
+    'name': u'benchmark',
+    'c': 42,
+    'r': 0.5,
+    'active': True,
+    'created': datetime.datetime(2012, 1, 1),
+    'tags': [u'a', u'b', u'c'],
+}
+
+
+def owned_size(document):
+    seen = set()
+
+    def size(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        total = sys.getsizeof(obj)
+        if isinstance(obj, list):
+            total += sum(size(item) for item in obj)
+        elif isinstance(obj, dict):
+            total += sum(size(key) + size(value)
+                         for key, value in obj.iteritems())
+        return total
+
+    total = sys.getsizeof(document)
+    seen.add(id(document))
+    if hasattr(document, '__dict__'):
+        total += size(document.__dict__)
+    else:
+        for name, _ in document._attributes:
+            total += size(getattr(document, name))
+        total += size(document._missing)
+        if document._data is not None:
+            total += size(document._data)
+    return total
+
+
+def main(count=10000):
+    baseline = None
+    for cls in (Plain, Slotted, SlottedWithoutData):
+        docs = [cls(dict(RAW, tags=list(RAW['tags'])), None)
+                for _ in xrange(count)]
+        per_instance = sum(owned_size(doc) for doc in docs) / float(count)
+        baseline = baseline or per_instance
+        print '%-20s %7.0f bytes/instance  (%.0f%%)' % (
+            cls.__name__, per_instance, 100 * per_instance / baseline)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,275 @@
+"""Benchmark suite for vultan's hot paths, with machine-readable results.
+
+Covers field conversion for every type in vultan.types, query and update
+encoding, document construction, key matching, and SimpleStorage CRUD. The
+CRUD cases run against vultan.memory's in-process collections (with the
+declared indexes built) unless
+--backend=mongod is given (or --backend=auto finds a server), so the suite
+needs no network by default.
+
+Usage: python bench/suite.py [--backend memory|mongod|auto] [--host HOST]
+                             [--port PORT] [--scale SCALE] [--repeat N]
+                             [--filter SUBSTRING] [--output FILE]
+
+Prints (or writes) one JSON object; per-call timings are in microseconds.
+"""
+import datetime
+import json
+import optparse
+import platform
+import sys
+import time
+import timeit
+
+import pymongo
+import pymongo.binary
+import pymongo.errors
+import pymongo.objectid
+import vultan.connection
+from vultan.document import Document, Index, Key
+from vultan.new import NewDocument, SimpleStorage
+from vultan.types import (BinaryField, BoolField, DateField, DatetimeField,
+                          EnumField, EnumSetField, FloatField, IdentityField,
+                          IntField, ListField, ObjectField, ObjectIdField,
+                          ObjectIdListField, ObjectIdSetField, SetField,
+                          StringField, TupleField, UrlField)
+
+SCHEMA_VERSION = 1
+
+OID = pymongo.objectid.ObjectId('4f0000000000000000000001')
+NOW = datetime.datetime(2012, 1, 1, 12, 30)
+
+# (name, field, a python value) for every field type.
+FIELDS = [
+    ('IdentityField', IdentityField(), {'a': 1}),
+    ('TupleField', TupleField(IntField(), StringField()), (1, u'a')),
+    ('ListField', ListField(StringField()), [u'a', u'b', u'c']),
+    ('SetField', SetField(IntField()), [1, 2, 2, 3]),
+    ('ObjectIdField', ObjectIdField(), str(OID)),
+    ('ObjectIdListField', ObjectIdListField(), [str(OID)] * 3),
+    ('ObjectIdSetField', ObjectIdSetField(), [str(OID)] * 3),
+    ('StringField', StringField(), u'benchmark'),
+    ('IntField', IntField(), 42),
+    ('FloatField', FloatField(), 0.5),
+    ('EnumField', EnumField(['a', 'b', 'c']), 'b'),
+    ('EnumSetField', EnumSetField(['a', 'b', 'c']), ['a', 'c']),
+    ('BoolField', BoolField(), True),
+    ('BinaryField', BinaryField(), '\x00\x01\x02'),
+    ('ObjectField', ObjectField(i=IntField(), s=StringField()),
+     {'i': 1, 's': u'x'}),
+    ('DateField', DateField(), NOW.date()),
+    ('DatetimeField', DatetimeField(), NOW),
+    ('UrlField', UrlField(), 'http://example.com/path'),
+]
+
+ATTRIBUTES = {
+    'name': StringField(),
+    'group': StringField().dbname('g'),
+    'count': IntField().dbname('c'),
+    'ratio': FloatField(),
+    'active': BoolField(),
+    'created': DatetimeField(),
+    'tags': ListField(StringField()),
+    'refs': ObjectIdListField(),
+    # Never set by DOC, so crud.save covers fields that can't encode None.
+    'expires': DateField(),
+    'span': TupleField(IntField(), IntField()),
+    'checksum': BinaryField(),
+}
+KEYS = [Key('name'), Index('group', 'count'), Index('tags')]
+
+
+class Item(Document):
+    _collection = 'bench_items'
+    _keys = KEYS
+    _attributes = ATTRIBUTES
+
+
+class BenchStorage(SimpleStorage):
+    _connection = 'vultan_bench'
+    _collection = 'bench_items'
+
+
+class NewItem(NewDocument):
+    _keys = KEYS
+    _attributes = ATTRIBUTES
+    _storage = BenchStorage
+
+
+class SlottedItem(NewItem):
+    _slots = True
+
+
+DOC = {
+    'name': u'item',
+    'group': u'g1',
+    'count': 42,
+    'ratio': 0.5,
+    'active': True,
+    'created': NOW,
+    'tags': [u'a', u'b', u'c'],
+    'refs': [str(OID)] * 3,
+}
+RAW = dict(Item._document_to_mongo(DOC), _id=OID)
+
+QUERY = {'group': u'g1', 'count': {'$gte': 1, '$lt': 100},
+         'tags': {'$in': [u'a', u'b']}}
+UPDATE = {'$set': {'ratio': 0.75, 'active': False},
+          '$push': {'tags': u'd'}, '$inc': {'count': 1}}
+
+
+def codec_cases():
+    for name, field, value in FIELDS:
+        raw = field.to_mongo(value)
+        yield ('field.%s.to_mongo' % name,
+               lambda field=field, value=value: field.to_mongo(value))
+        yield ('field.%s.from_mongo' % name,
+               lambda field=field, raw=raw: field.from_mongo(raw))
+    yield 'document.encode', lambda: Item._document_to_mongo(DOC)
+    yield 'document.query_to_mongo', lambda: Item._query_to_mongo(QUERY)
+    yield 'document.update_to_mongo', lambda: Item._update_to_mongo(UPDATE)
+    yield 'construct.Document', lambda: Item(RAW, None)
+    yield 'construct.NewDocument', lambda: NewItem(RAW, None)
+    yield 'construct.NewDocument.slotted', lambda: SlottedItem(RAW, None)
+    yield 'keyset.match.unique', lambda: Item._keys.match({'name': 1}, True)
+    yield 'keyset.match.index', \
+        lambda: Item._keys.match({'group': 1, 'count': 2})
+
+
+def crud_cases(storage, scale):
+    """Yields (name, setup, function) triples. Each case gets a freshly
+    populated collection of `scale` documents from `setup`."""
+    docs = [dict(DOC, name=u'item%d' % i, group=u'g%d' % (i % 10), count=i)
+            for i in xrange(scale)]
+    counter = [0]
+
+    def populate():
+        storage._get_collection().remove()
+        storage.insert_many(docs)
+
+    def fresh_name():
+        counter[0] += 1
+        return u'new%d' % counter[0]
+
+    def last_name():
+        return u'item%d' % (scale - 1)
+
+    def save():
+        counter[0] += 1
+        item = storage.find_one(name=last_name())
+        item.ratio = float(counter[0])
+        assert item.save()
+
+    yield ('crud.insert', populate,
+           lambda: storage.insert(**dict(DOC, name=fresh_name())))
+    yield ('crud.find_one', populate,
+           lambda: storage.find_one(name=last_name()))
+    yield ('crud.find', populate,
+           lambda: storage.find(group=u'g3', count={'$gte': 0}))
+    yield ('crud.values_list', populate,
+           lambda: list(storage.values_list(['count'], group=u'g3')))
+    yield ('crud.find_covered', populate,
+           lambda: storage.find_covered(['count'], group=u'g3'))
+    yield ('crud.count', populate, lambda: storage.count(group=u'g3'))
+    yield ('crud.set_one', populate,
+           lambda: storage.set_one(dict(name=last_name()), ratio=0.25))
+    yield ('crud.save', populate, save)
+    yield ('crud.update', populate,
+           lambda: storage.update(dict(group=u'g3'), **{'$inc': {'count': 1}}))
+    yield ('crud.upsert', populate,
+           lambda: storage.upsert(dict(name=fresh_name()),
+                                  **{'$set': {'ratio': 0.1}}))
+    yield ('crud.remove', populate,
+           lambda: storage.remove(name=fresh_name()))
+
+
+def measure(function, number, repeat, setup=None):
+    """Returns per-call timings in microseconds for `function`."""
+    timings = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        timings.append(timeit.timeit(function, number=number) / number * 1e6)
+    timings.sort()
+    return dict(iterations=number, repeat=repeat, best=timings[0],
+                median=timings[len(timings) // 2], worst=timings[-1])
+
+
+def connect(backend, host, port):
+    """Registers BenchStorage's connection; returns the backend used."""
+    alias = BenchStorage._connection
+    if backend in ('mongod', 'auto'):
+        vultan.connection.register(alias, host, port, db='vultan_bench')
+        try:
+            vultan.connection.get_database(alias)
+            return 'mongod'
+        except pymongo.errors.ConnectionFailure:
+            if backend == 'mongod':
+                raise
+    vultan.connection.register(alias, db='vultan_bench', backend='memory')
+    return 'memory'
+
+
+def get_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('vultan').version
+    except Exception:
+        return None
+
+
+def run(options):
+    backend = connect(options.backend, options.host, options.port)
+    storage = NewItem.DB
+    storage._get_collection().drop()
+    storage.create_indexes()
+    number = 1000 * options.scale
+
+    results = {}
+    for name, function in codec_cases():
+        if options.filter in name:
+            results[name] = measure(function, number, options.repeat)
+    for name, setup, function in crud_cases(storage, 100 * options.scale):
+        if options.filter in name:
+            results[name] = measure(function, number // 10, options.repeat,
+                                    setup)
+    storage._get_collection().drop()
+
+    return {
+        'schema': SCHEMA_VERSION,
+        'vultan': get_version(),
+        'python': platform.python_version(),
+        'pymongo': pymongo.version,
+        'platform': platform.platform(),
+        'backend': backend,
+        'scale': options.scale,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'unit': 'us',
+        'results': results,
+    }
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.split('Usage: ')[1])
+    parser.add_option('--backend', default='memory',
+                      choices=['memory', 'mongod', 'auto'])
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', type='int', default=27017)
+    parser.add_option('--scale', type='int', default=1,
+                      help='multiplies iteration and collection sizes')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--filter', default='',
+                      help='only run cases whose names contain this')
+    parser.add_option('--output', help='write JSON here instead of stdout')
+    options, _ = parser.parse_args(argv)
+
+    report = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
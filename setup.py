@@ -4,7 +4,8 @@ setup(
     name = "vultan",
     version = "0.2",
     packages = find_packages(),
-    install_requires = ['setuptools', 'pymongo>=1.5'],
+    install_requires = ['setuptools', 'pymongo>=2.1'],
+    extras_require = {'async': ['futures'], 'columns': ['numpy']},
     author = "Daniel Cowgill",
     author_email = "dcowgill@gmail.com",
     description = "High-level python interface for working with MongoDB documents.",
@@ -0,0 +1,64 @@
+import unittest
+import vultan.advisor
+import vultan.connection
+from vultan.document import Index, Key
+from vultan.new import NewDocument, SimpleStorage
+from vultan.types import IntField, StringField
+
+ALIAS = 'vultan_test'
+OTHER_ALIAS = 'vultan_test_other'
+
+
+class ItemStorage(SimpleStorage):
+    _connection = ALIAS
+    _collection = 'items'
+
+
+class Item(NewDocument):
+    _storage = ItemStorage
+    _keys = [Key('name'), Index('n')]
+    _attributes = {'name': StringField(), 'n': IntField(),
+                   'age': IntField().dbname('a')}
+
+
+class OtherItemStorage(ItemStorage):
+    _connection = OTHER_ALIAS
+
+
+class AdviseTest(unittest.TestCase):
+    def setUp(self):
+        vultan.connection.register(ALIAS, db='test', backend='memory')
+        vultan.connection.register(OTHER_ALIAS, db='other', backend='memory')
+        self.recorder = vultan.advisor.QueryRecorder()
+
+    def tearDown(self):
+        self.recorder.stop()
+        vultan.connection.disconnect(ALIAS)
+        vultan.connection.disconnect(OTHER_ALIAS)
+
+    def test_accepts_document_classes(self):
+        with self.recorder:
+            Item.DB._find({'age': 3}, require_index=False)
+            Item.DB.find(n=1)
+            Item.DB.find(name=u'x')
+        advice = vultan.advisor.advise(self.recorder, [Item])
+        self.assertEqual([(s.collection, s.index.names)
+                          for s in advice.suggestions],
+                         [('test.items', ['age'])])
+        self.assertEqual(advice.unused, [])
+
+    def test_shapes_are_kept_per_database(self):
+        other = OtherItemStorage(Item)
+        with self.recorder:
+            other._find({'age': 3}, require_index=False)
+        advice = vultan.advisor.advise(self.recorder, [Item, other])
+        self.assertEqual([s.collection for s in advice.suggestions],
+                         ['other.items'])
+        self.assertEqual([(collection, key.names)
+                          for collection, key in advice.unused],
+                         [('other.items', ['name']), ('other.items', ['n']),
+                          ('test.items', ['name']), ('test.items', ['n'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import concurrent.futures
+import unittest
+import vultan.async_storage
+
+
+class ManualExecutor(object):
+    """Hands out futures that the test resolves or cancels itself."""
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.futures.append(future)
+        return future
+
+
+class LimiterTest(unittest.TestCase):
+    def test_runs_queued_calls_as_slots_free(self):
+        executor = ManualExecutor()
+        limiter = vultan.async_storage._Limiter(executor, 1)
+        first, second = limiter.submit(len, 'a'), limiter.submit(len, 'b')
+        self.assertEqual(len(executor.futures), 1)
+        executor.futures[0].set_result(1)
+        self.assertEqual(first.result(0), 1)
+        self.assertEqual(len(executor.futures), 2)
+        executor.futures[1].set_result(2)
+        self.assertEqual(second.result(0), 2)
+        self.assertEqual(limiter._running, 0)
+
+    def test_cancelled_jobs_release_their_slot(self):
+        executor = ManualExecutor()
+        limiter = vultan.async_storage._Limiter(executor, 1)
+        first, second = limiter.submit(len, 'a'), limiter.submit(len, 'b')
+        executor.futures[0].cancel()
+        self.assertRaises(concurrent.futures.CancelledError, first.result, 0)
+        executor.futures[1].set_result(2)
+        self.assertEqual(second.result(0), 2)
+        self.assertEqual(limiter._running, 0)
+
+    def test_shut_down_executor_fails_calls(self):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        limiter = vultan.async_storage._Limiter(executor, 1)
+        executor.shutdown()
+        futures = [limiter.submit(len, 'a') for _ in range(3)]
+        for future in futures:
+            self.assertRaises(RuntimeError, future.result, 0)
+        self.assertEqual(limiter._running, 0)
+
+    def test_shutdown_fails_queued_calls(self):
+        executor = ManualExecutor()
+        limiter = vultan.async_storage._Limiter(executor, 1)
+        first = limiter.submit(len, 'a')
+        queued = [limiter.submit(len, 'b') for _ in range(2000)]
+
+        def refuse(fn, *args, **kwargs):
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        executor.submit = refuse
+        executor.futures[0].set_result(1)
+        self.assertEqual(first.result(0), 1)
+        for future in queued:
+            self.assertRaises(RuntimeError, future.result, 0)
+        self.assertEqual(limiter._running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import pymongo.errors
+import vultan.bulk
+
+
+class FakeDatabase(object):
+    """Answers "update" write commands, failing the operations it is told
+    to, and every command after the first `fail_after` with `error`."""
+    def __init__(self, failing=(), error=None, fail_after=0):
+        self.commands = []
+        self._failing = failing
+        self._error = error
+        self._fail_after = fail_after
+
+    def command(self, command):
+        self.commands.append(command)
+        if self._error is not None and len(self.commands) > self._fail_after:
+            raise pymongo.errors.OperationFailure(self._error)
+        updates = command['updates']
+        errors = [dict(index=i, code=11000, errmsg='E11000 duplicate key')
+                  for i, update in enumerate(updates)
+                  if update['q']['name'] in self._failing]
+        return {'ok': 1, 'n': len(updates) - len(errors),
+                'nModified': len(updates) - len(errors), 'writeErrors': errors}
+
+
+class FakeCollection(object):
+    name = 'items'
+
+    def __init__(self, database):
+        self.database = database
+
+
+def operations(count, size=0):
+    return [({'name': 'n%d' % i}, {'$set': {'blob': 'x' * size}})
+            for i in range(count)]
+
+
+def encode(operation):
+    if operation[0]['name'] == 'bad':
+        raise ValueError('bad')
+    return operation
+
+
+class BulkUpdateTest(unittest.TestCase):
+    def run_update(self, database, ops, **kwargs):
+        return vultan.bulk.bulk_update(FakeCollection(database), ops, encode,
+                                       **kwargs)
+
+    def test_batches_are_bounded_by_bytes(self):
+        database = FakeDatabase()
+        result = self.run_update(database, operations(10, 1000),
+                                 batch_bytes=3500)
+        self.assertEqual([len(command['updates'])
+                          for command in database.commands], [3, 3, 3, 1])
+        self.assertEqual(result.matched, 10)
+
+    def test_batches_are_bounded_by_count(self):
+        database = FakeDatabase()
+        self.run_update(database, operations(5), batch_size=2)
+        self.assertEqual([len(command['updates'])
+                          for command in database.commands], [2, 2, 1])
+
+    def test_errors_are_exceptions(self):
+        ops = operations(3) + [({'name': 'bad'}, {})]
+        result = self.run_update(FakeDatabase(failing=['n1']), ops,
+                                 ordered=False)
+        errors = sorted(result.errors)
+        self.assertEqual([index for index, _ in errors], [1, 3])
+        server_error, encode_error = [error for _, error in errors]
+        self.assertTrue(isinstance(server_error,
+                                   pymongo.errors.OperationFailure))
+        self.assertEqual(server_error.code, 11000)
+        self.assertTrue(isinstance(encode_error, ValueError))
+
+    def test_failed_command_keeps_partial_result(self):
+        database = FakeDatabase(error='not master', fail_after=1)
+        result = self.run_update(database, operations(6), batch_size=2,
+                                 ordered=False)
+        self.assertEqual(len(database.commands), 2)
+        self.assertEqual(result.matched, 2)
+        self.assertEqual([index for index, _ in result.errors], [2])
+        self.assertEqual(str(result.errors[0][1]), 'not master')
+
+    def test_sent_sees_every_batch(self):
+        batches = []
+        self.run_update(FakeDatabase(), operations(3), batch_size=2,
+                        sent=batches.append)
+        self.assertEqual([[spec['name'] for spec in specs]
+                          for specs in batches], [['n0', 'n1'], ['n2']])
+
+
+if __name__ == '__main__':
+    unittest.main()
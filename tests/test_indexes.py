@@ -0,0 +1,63 @@
+import unittest
+import vultan.connection
+import vultan.indexes
+from vultan.document import Index, Key
+from vultan.new import NewDocument, SimpleStorage
+from vultan.types import IntField, StringField
+
+ALIAS = 'vultan_test'
+
+
+class ItemStorage(SimpleStorage):
+    _connection = ALIAS
+    _collection = 'items'
+
+
+class Item(NewDocument):
+    _storage = ItemStorage
+    _keys = [Key('name'), Index('n')]
+    _attributes = {'name': StringField(), 'n': IntField()}
+
+
+class ReconcileTest(unittest.TestCase):
+    def setUp(self):
+        vultan.connection.register(ALIAS, db='test', backend='memory')
+        self.collection = Item.DB._get_collection()
+
+    def tearDown(self):
+        vultan.connection.disconnect(ALIAS)
+
+    def indexes(self):
+        info = self.collection.index_information()
+        return sorted((name, bool(info[name].get('unique')))
+                      for name in info if name != '_id_')
+
+    def test_creates_and_drops(self):
+        self.collection.create_index([('old', 1)])
+        self.assertEqual(Item.DB.create_indexes(),
+                         (['n_1', 'name_1'], ['old_1']))
+        self.assertEqual(self.indexes(), [('n_1', False), ('name_1', True)])
+        self.assertEqual(Item.DB.create_indexes(), (['n_1', 'name_1'], []))
+
+    def test_dry_run_changes_nothing(self):
+        plan, = vultan.indexes.reconcile([Item], dry_run=True)
+        self.assertEqual([name for name, _, _ in plan.create],
+                         ['n_1', 'name_1'])
+        self.assertFalse(plan.applied)
+        self.assertEqual(self.indexes(), [])
+
+    def test_uniqueness_change_under_same_name(self):
+        self.collection.create_index([('name', 1)], unique=False)
+        Item.DB.create_indexes()
+        self.assertEqual(self.indexes(), [('n_1', False), ('name_1', True)])
+
+    def test_uniqueness_change_under_custom_name(self):
+        self.collection.create_index([('name', 1)], name='by_name')
+        self.collection.create_index([('n', 1)], name='by_n', unique=True)
+        self.assertEqual(Item.DB.create_indexes(),
+                         (['n_1', 'name_1'], ['by_n', 'by_name']))
+        self.assertEqual(self.indexes(), [('n_1', False), ('name_1', True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
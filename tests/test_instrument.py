@@ -0,0 +1,78 @@
+import logging
+import unittest
+import vultan.connection
+import vultan.errors
+import vultan.instrument
+import vultan.memory
+from vultan.document import Key
+from vultan.new import NewDocument, SimpleStorage
+from vultan.types import StringField
+
+ALIAS = 'vultan_test'
+
+
+class ThingStorage(SimpleStorage):
+    _connection = ALIAS
+    _collection = 'things'
+
+
+class Thing(NewDocument):
+    _storage = ThingStorage
+    _keys = [Key('name')]
+    _attributes = {'name': StringField()}
+
+
+class Handler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def broken_listener(record):
+    raise RuntimeError('metrics sink is down')
+
+
+class InstrumentTest(unittest.TestCase):
+    def setUp(self):
+        vultan.connection.register(ALIAS, db='test', backend='memory')
+        self.handler = Handler()
+        vultan.instrument.error_logger.addHandler(self.handler)
+        vultan.instrument.logger.addHandler(self.handler)
+        vultan.instrument.add_listener(broken_listener)
+
+    def tearDown(self):
+        vultan.instrument.remove_listener(broken_listener)
+        vultan.instrument.set_slow_threshold(None)
+        vultan.instrument.error_logger.removeHandler(self.handler)
+        vultan.instrument.logger.removeHandler(self.handler)
+        vultan.connection.disconnect(ALIAS)
+
+    def test_listener_errors_dont_reach_callers(self):
+        Thing.DB.insert(name=u'a')
+        self.assertEqual(Thing.DB.find_one(name=u'a').name, u'a')
+        self.assertEqual(len(self.handler.records), 2)  # one per call
+        self.assertTrue('metrics sink' in str(self.handler.records[0].exc_info[1]))
+
+    def test_listener_errors_dont_replace_exceptions(self):
+        self.assertRaises(vultan.errors.KeyMatchError, Thing.DB.find_one,
+                          other=u'a')
+
+    def test_explain_errors_are_logged(self):
+        vultan.instrument.set_slow_threshold(0)
+        explain = vultan.memory.MemoryCursor.explain
+        vultan.memory.MemoryCursor.explain = lambda cursor: 1 / 0
+        try:
+            self.assertEqual(Thing.DB.count(name=u'a'), 0)
+        finally:
+            vultan.memory.MemoryCursor.explain = explain
+        errors = [record.exc_info[0] for record in self.handler.records
+                  if record.exc_info]
+        self.assertEqual(errors, [RuntimeError, ZeroDivisionError])
+        self.assertTrue('slow count' in self.handler.records[-1].getMessage())
+
+
+if __name__ == '__main__':
+    unittest.main()
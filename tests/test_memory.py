@@ -0,0 +1,150 @@
+import unittest
+import pymongo
+import pymongo.errors
+import vultan.memory
+
+
+class MemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.collection = vultan.memory.MemoryConnection()['test']['items']
+
+    def insert(self, *docs):
+        self.collection.insert(list(docs))
+
+    def names(self, spec, **kwargs):
+        return sorted(doc['name'] for doc in self.collection.find(spec, **kwargs))
+
+
+class QueryMatchingTest(MemoryTestCase):
+    def setUp(self):
+        super(QueryMatchingTest, self).setUp()
+        self.insert({'name': 'a', 'n': 1, 'tags': ['x', 'y'], 'sub': {'k': 1}},
+                    {'name': 'b', 'n': 2, 'tags': ['y']},
+                    {'name': 'c', 'n': 'two', 'tags': []},
+                    {'name': 'd', 'n': None},
+                    {'name': 'e'})
+
+    def test_equality(self):
+        self.assertEqual(self.names({'n': 1}), ['a'])
+        self.assertEqual(self.names({'n': 1.0}), ['a'])
+        self.assertEqual(self.names({'sub.k': 1}), ['a'])
+
+    def test_null_matches_missing(self):
+        self.assertEqual(self.names({'n': None}), ['d', 'e'])
+        self.assertEqual(self.names({'n': {'$exists': False}}), ['e'])
+        self.assertEqual(self.names({'n': {'$ne': None}}), ['a', 'b', 'c'])
+
+    def test_comparisons_are_type_bracketed(self):
+        self.assertEqual(self.names({'n': {'$gt': 0}}), ['a', 'b'])
+        self.assertEqual(self.names({'n': {'$gte': 'a'}}), ['c'])
+        self.assertEqual(self.names({'n': {'$gt': None}}), [])
+
+    def test_arrays_match_any_item(self):
+        self.assertEqual(self.names({'tags': 'y'}), ['a', 'b'])
+        self.assertEqual(self.names({'tags': {'$all': ['x', 'y']}}), ['a'])
+        self.assertEqual(self.names({'tags': {'$size': 0}}), ['c'])
+        self.assertEqual(self.names({'tags': {'$in': ['x', 'z']}}), ['a'])
+        self.assertEqual(self.names({'tags': {'$nin': ['y']}}),
+                         ['c', 'd', 'e'])
+
+    def test_logical_operators(self):
+        self.assertEqual(self.names({'$or': [{'n': 1}, {'name': 'c'}]}),
+                         ['a', 'c'])
+        self.assertEqual(self.names({'$and': [{'tags': 'y'}, {'n': 2}]}),
+                         ['b'])
+        self.assertEqual(self.names({'$nor': [{'tags': 'y'}, {'n': None}]}),
+                         ['c'])
+
+    def test_sort_orders_types(self):
+        docs = self.collection.find({}, sort=[('n', pymongo.ASCENDING),
+                                              ('name', pymongo.ASCENDING)])
+        self.assertEqual([doc['name'] for doc in docs],
+                         ['d', 'e', 'a', 'b', 'c'])
+
+    def test_unknown_operator(self):
+        self.assertRaises(pymongo.errors.OperationFailure,
+                          list, self.collection.find({'n': {'$where': 1}}))
+
+
+class IndexMaintenanceTest(MemoryTestCase):
+    def setUp(self):
+        super(IndexMaintenanceTest, self).setUp()
+        self.collection.create_index([('name', 1)], unique=True)
+        self.collection.create_index([('group', 1), ('n', 1)])
+        self.insert({'name': 'a', 'group': 'g1', 'n': 1},
+                    {'name': 'b', 'group': 'g1', 'n': 2},
+                    {'name': 'c', 'group': 'g2', 'n': 3})
+
+    def explain(self, spec, **kwargs):
+        return self.collection.find(spec, **kwargs).explain()
+
+    def test_lookup_uses_index(self):
+        plan = self.explain({'group': 'g1', 'n': {'$gt': 1}})
+        self.assertEqual(plan['cursor'], 'BtreeCursor group_1_n_1')
+        self.assertEqual((plan['nscanned'], plan['n']), (2, 1))
+        plan = self.explain({'name': {'$in': ['a', 'c', 'z']}})
+        self.assertEqual((plan['nscanned'], plan['n']), (2, 2))
+        self.assertEqual(self.explain({'n': 1})['cursor'], 'BasicCursor')
+
+    def test_unique_index(self):
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.insert, {'name': 'a'})
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.collection.update, {'name': 'b'},
+                          {'$set': {'name': 'a'}}, safe=True)
+        self.assertEqual(self.names({'name': 'b'}), ['b'])
+
+    def test_update_moves_entries(self):
+        self.collection.update({'name': 'a'}, {'$set': {'group': 'g2'}},
+                               safe=True)
+        self.assertEqual(self.names({'group': 'g1'}), ['b'])
+        self.assertEqual(self.names({'group': 'g2'}), ['a', 'c'])
+        self.assertEqual(self.explain({'group': 'g2'})['nscanned'], 2)
+        self.collection.update({'name': 'a'}, {'name': 'z', 'group': 'g1'},
+                               safe=True)
+        self.assertEqual(self.names({'name': 'a'}), [])
+        self.assertEqual(self.names({'group': 'g1'}), ['b', 'z'])
+        self.insert({'name': 'a'})  # the old unique value is free again
+
+    def test_remove_drops_entries(self):
+        self.collection.remove({'group': 'g1'}, safe=True)
+        self.assertEqual(self.explain({'group': 'g1'})['nscanned'], 0)
+        self.insert({'name': 'a', 'group': 'g1'})
+        self.assertEqual(self.names({'group': 'g1'}), ['a'])
+
+    def test_multikey(self):
+        self.collection.create_index('tags')
+        self.insert({'name': 'd', 'tags': ['x', 'y']})
+        plan = self.explain({'tags': 'y'})
+        self.assertEqual((plan['cursor'], plan['n']), ('BtreeCursor tags_1', 1))
+        self.collection.update({'name': 'd'}, {'$pull': {'tags': 'y'}},
+                               safe=True)
+        self.assertEqual(self.explain({'tags': 'y'})['nscanned'], 0)
+
+    def test_hint_and_covered(self):
+        cursor = self.collection.find({'group': 'g1'},
+                                      fields={'n': 1, '_id': 0})
+        cursor.hint([('group', 1), ('n', 1)])
+        plan = cursor.explain()
+        self.assertTrue(plan['indexOnly'])
+        self.assertEqual(sorted(doc['n'] for doc in cursor), [1, 2])
+        cursor = self.collection.find({}).hint('missing')
+        self.assertRaises(pymongo.errors.OperationFailure, list, cursor)
+
+    def test_create_index_checks_existing(self):
+        self.insert({'name': 'd', 'group': 'g1'})
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.collection.create_index, 'group', unique=True)
+        self.assertEqual(sorted(self.collection.index_information()),
+                         ['_id_', 'group_1_n_1', 'name_1'])
+
+    def test_drop_index(self):
+        self.collection.drop_index('group_1_n_1')
+        self.assertEqual(self.explain({'group': 'g1'})['cursor'],
+                         'BasicCursor')
+        self.assertRaises(pymongo.errors.OperationFailure,
+                          self.collection.drop_index, 'group_1_n_1')
+
+
+if __name__ == '__main__':
+    unittest.main()
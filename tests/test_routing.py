@@ -0,0 +1,65 @@
+import threading
+import unittest
+import vultan.routing
+
+
+class SlowTopology(vultan.routing.ReplicaSetTopology):
+    """Answers lags from a list, blocking each fetch until `release`."""
+    def __init__(self, lags):
+        self.now = 0.0
+        vultan.routing.ReplicaSetTopology.__init__(
+            self, 'unused', refresh_interval=10, clock=lambda: self.now)
+        self.lags = list(lags)
+        self.fetching = threading.Event()
+        self.release = threading.Event()
+        self.fetches = 0
+
+    def _fetch_lag(self):
+        self.fetches += 1
+        self.fetching.set()
+        self.release.wait(5)
+        lag = self.lags.pop(0)
+        if isinstance(lag, Exception):
+            raise lag
+        return lag
+
+
+class ReplicaSetTopologyTest(unittest.TestCase):
+    def test_caches_for_the_refresh_interval(self):
+        topology = SlowTopology([1, 2])
+        topology.release.set()
+        self.assertEqual(topology.secondary_lag(), 1)
+        topology.now = 9
+        self.assertEqual(topology.secondary_lag(), 1)
+        topology.now = 10
+        self.assertEqual(topology.secondary_lag(), 2)
+        self.assertEqual(topology.fetches, 2)
+
+    def test_readers_dont_wait_for_a_refresh(self):
+        topology = SlowTopology([1, 2])
+        topology.release.set()
+        topology.secondary_lag()
+        topology.release.clear()
+        topology.fetching.clear()
+        topology.now = 10
+        results = []
+        refresher = threading.Thread(
+            target=lambda: results.append(topology.secondary_lag()))
+        refresher.start()
+        self.assertTrue(topology.fetching.wait(5))
+        self.assertEqual(topology.secondary_lag(), 1)  # stale, not blocked
+        topology.release.set()
+        refresher.join(5)
+        self.assertEqual(results, [2])
+        self.assertEqual(topology.secondary_lag(), 2)
+        self.assertEqual(topology.fetches, 2)
+
+    def test_failed_refresh_is_retried(self):
+        topology = SlowTopology([ValueError('boom'), 3])
+        topology.release.set()
+        self.assertRaises(ValueError, topology.secondary_lag)
+        self.assertEqual(topology.secondary_lag(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
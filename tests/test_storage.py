@@ -0,0 +1,248 @@
+import unittest
+import vultan.bulk
+import vultan.connection
+import vultan.errors
+import vultan.new
+from vultan.document import Index, Key
+from vultan.new import NewDocument, SimpleStorage
+from vultan.types import IntField, ListField, StringField
+
+ALIAS = 'vultan_test'
+
+
+class ItemStorage(SimpleStorage):
+    _connection = ALIAS
+    _collection = 'items'
+
+
+class Item(NewDocument):
+    _storage = ItemStorage
+    _keys = [Key('name'), Index('group', 'n', 'id'), Index('age', 'id'),
+             Index(('age', -1), ('id', -1)), Index('tags')]
+    _attributes = {
+        'name': StringField(),
+        'group': StringField().dbname('g'),
+        'n': IntField(),
+        'age': IntField(),
+        'tags': ListField(StringField()),
+    }
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        vultan.connection.register(ALIAS, db='test', backend='memory')
+        self.storage = Item.DB
+        self.storage.create_indexes()
+
+    def tearDown(self):
+        vultan.connection.disconnect(ALIAS)
+
+    def insert(self, *docs):
+        result = self.storage.insert_many(docs)
+        self.assertTrue(result.ok, result.errors)
+        return result.ids
+
+
+class FindPageTest(StorageTestCase):
+    def pages(self, query, index=None, limit=2):
+        pages = []
+        token = None
+        while True:
+            docs, token = self.storage.find_page(query, index, token, limit)
+            pages.append([doc.name for doc in docs])
+            if token is None:
+                return pages
+
+    def test_pages_whole_collection(self):
+        self.insert(*[dict(name=u'n%d' % i) for i in range(5)])
+        self.assertEqual(self.pages({}),
+                         [[u'n0', u'n1'], [u'n2', u'n3'], [u'n4']])
+
+    def test_pages_by_index_with_ties(self):
+        self.insert(*[dict(name=u'n%d' % i, group=u'g', n=i % 2)
+                      for i in range(5)])
+        pages = self.pages({'group': u'g'}, Index('group', 'n', 'id'))
+        names = sum(pages, [])
+        self.assertEqual(sorted(names), [u'n%d' % i for i in range(5)])
+        self.assertEqual(len(pages), 3)
+        docs = [self.storage.find_one(name=name) for name in names]
+        self.assertEqual([doc.n for doc in docs], [0, 0, 0, 1, 1])
+
+    def test_pages_by_unique_key(self):
+        self.insert(*[dict(name=u'n%d' % i) for i in (3, 1, 2)])
+        self.assertEqual(self.pages({}, Key('name')),
+                         [[u'n1', u'n2'], [u'n3']])
+
+    def test_missing_values_sort_first(self):
+        self.insert(dict(name=u'n1'), dict(name=u'n2', age=None),
+                    *[dict(name=u'a%d' % i, age=i) for i in (3, 1, 4, 2)])
+        names = sum(self.pages({}, Index('age', 'id'), limit=1), [])
+        self.assertEqual(names[:2], [u'n1', u'n2'])
+        self.assertEqual(names[2:], [u'a1', u'a2', u'a3', u'a4'])
+
+    def test_missing_values_sort_last_descending(self):
+        self.insert(dict(name=u'n1'), dict(name=u'n2', age=None),
+                    *[dict(name=u'a%d' % i, age=i) for i in (3, 1, 4, 2)])
+        names = sum(self.pages({}, Index(('age', -1), ('id', -1)), limit=1),
+                    [])
+        self.assertEqual(names[:4], [u'a4', u'a3', u'a2', u'a1'])
+        self.assertEqual(sorted(names[4:]), [u'n1', u'n2'])
+
+    def test_seek_bounds_the_first_free_field(self):
+        self.insert(*[dict(name=u'n%d' % i, group=u'g', n=i, age=i)
+                      for i in range(6)])
+        collection = self.storage._get_collection()
+        find = collection.find
+        specs = []
+        collection.find = lambda spec=None, **kwargs: \
+            specs.append(spec) or find(spec, **kwargs)
+        try:
+            for query, index in [({}, Index('age', 'id')),
+                                 ({'group': u'g'}, Index('group', 'n', 'id'))]:
+                _, token = self.storage.find_page(query, index, limit=2)
+                self.storage.find_page(query, index, token, 2)
+        finally:
+            del collection.find
+        self.assertEqual(specs[1]['age'], {'$gte': 1})
+        self.assertEqual(specs[3]['n'], {'$gte': 1})
+
+    def test_index_must_order_pages(self):
+        self.assertRaises(vultan.errors.KeyMatchError, self.storage.find_page,
+                          {}, Index('n'))
+        self.assertRaises(vultan.errors.KeyMatchError, self.storage.find_page,
+                          {}, Index('tags'))
+
+
+class FindManyTest(StorageTestCase):
+    def test_maps_every_value(self):
+        self.insert(*[dict(name=u'n%d' % i, n=i) for i in range(5)])
+        found = self.storage._find_many(
+            'name', [u'n0', u'n3', u'n3', u'n4', u'x'], chunk_size=2)
+        self.assertEqual(sorted(found), [u'n0', u'n3', u'n4', u'x'])
+        self.assertEqual(found[u'n3'].n, 3)
+        self.assertEqual(found[u'x'], None)
+
+    def test_by_id(self):
+        ids = self.insert(dict(name=u'a'), dict(name=u'b'))
+        found = self.storage._find_many('id', ids + ['0' * 24], chunk_size=1)
+        self.assertEqual([found[_id].name for _id in ids], [u'a', u'b'])
+        self.assertEqual(found['0' * 24], None)
+
+
+def item_name(item):
+    return item.name
+
+
+def item_n(item):
+    return item.n
+
+
+def add(x, y):
+    return x + y
+
+
+class ParallelScanTest(StorageTestCase):
+    def setUp(self):
+        super(ParallelScanTest, self).setUp()
+        self.insert(*[dict(name=u'n%02d' % i, n=i) for i in range(25)])
+
+    def test_scans_every_document(self):
+        names = self.storage.parallel_scan({}, workers=2, mapper=item_name,
+                                           chunk_size=3)
+        self.assertEqual(sorted(names), [u'n%02d' % i for i in range(25)])
+
+    def test_reduces_per_range(self):
+        total = self.storage.parallel_reduce({'n': {'$gte': 5}},
+                                             item_n, add,
+                                             workers=2)
+        self.assertEqual(total, sum(range(5, 25)))
+
+    def test_ranges_come_back_in_chunks(self):
+        task = (ItemStorage, Item, {}, None, None, item_name, None, 10)
+        chunks = []
+        while task is not None:
+            values, task = vultan.new._scan_range(task)
+            chunks.append(values)
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual(sorted(sum(chunks, [])),
+                         [u'n%02d' % i for i in range(25)])
+
+
+class FindCoveredTest(StorageTestCase):
+    def test_rows_come_from_the_index(self):
+        self.insert(dict(name=u'a', group=u'g1', n=1),
+                    dict(name=u'b', group=u'g1', n=2),
+                    dict(name=u'c', group=u'g2', n=3))
+        self.assertEqual(sorted(self.storage.find_covered(['n'], group=u'g1')),
+                         [(1,), (2,)])
+        cursor = self.storage._find_covered({'group': u'g1'}, ['n'])
+        self.assertTrue(cursor._cursor.explain()['indexOnly'])
+
+    def test_multikey_index_never_covers(self):
+        self.assertEqual(self.storage._covering_index({'tags': u'x'},
+                                                      ['tags']), None)
+
+
+class CachedItemStorage(ItemStorage):
+    _cache_size = 10
+
+
+class CacheTest(StorageTestCase):
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        self.storage = CachedItemStorage(Item)
+        self.insert(dict(name=u'a', n=1))
+
+    def test_hits_are_private_copies(self):
+        first = self.storage.find_one(name=u'a')
+        first.n = 5
+        second = self.storage.find_one(name=u'a')
+        self.assertEqual(second.n, 1)
+        self.assertFalse(first is second)
+        self.assertEqual(self.storage.cache_stats()['hits'], 1)
+
+    def test_bulk_writes_invalidate(self):
+        self.storage.find_one(name=u'a')
+        self.storage.bulk_update([(dict(name=u'a'), {'$set': {'n': 2}})])
+        self.assertEqual(self.storage.find_one(name=u'a').n, 2)
+        self.storage._get_collection().remove({'name': u'a'})
+        self.storage.insert_many([dict(name=u'a', n=3)])
+        self.assertEqual(self.storage.find_one(name=u'a').n, 3)
+
+
+class BulkTest(StorageTestCase):
+    def test_bulk_update_falls_back_to_single_updates(self):
+        self.insert(dict(name=u'a', n=1), dict(name=u'b', n=2))
+        result = self.storage.bulk_update([
+            (dict(name=u'a'), {'$inc': {'n': 10}}),
+            (dict(name=u'b'), {'$inc': {'n': 10}}),
+            (dict(name=u'z'), {'$inc': {'n': 10}}),
+        ])
+        self.assertEqual((result.matched, result.upserted, result.errors),
+                         (2, 0, []))
+        self.assertEqual(self.storage.find_one(name=u'b').n, 12)
+
+    def test_bulk_upsert(self):
+        self.insert(dict(name=u'a', n=1))
+        result = self.storage.bulk_upsert([
+            (dict(name=u'a'), {'$set': {'n': 5}}),
+            (dict(name=u'b'), {'$set': {'n': 6}}),
+        ])
+        self.assertEqual((result.matched, result.upserted), (1, 1))
+        self.assertEqual(result.upserted_ids.keys(), [1])
+        self.assertEqual(self.storage.find_one(name=u'b').n, 6)
+
+    def test_insert_many_records_failures(self):
+        self.insert(dict(name=u'a'))
+        result = self.storage._insert_many(
+            iter([dict(name=u'b'), dict(n=1), dict(name=u'a'),
+                  dict(name=u'c')]),
+            ordered=False, chunk_size=1)
+        self.assertEqual([error[:2] for error in result.errors],
+                         [(1, 1), (2, 1)])
+        self.assertEqual(len(result.ids), 2)
+        self.assertEqual(self.storage.count(name={'$in': [u'b', u'c']}), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
+from vultan.connection import register, get_database, disconnect
 from vultan.document import Index, Key, ReadOnlyDocument, Document
 
-# TODO: consider returning query results as generators, not lists.
 # TODO: Storage._get_collection() should probably be public. It's useful.
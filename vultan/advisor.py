@@ -0,0 +1,295 @@
+"""Records the shapes of the queries an application makes and suggests
+the Index declarations that would serve them.
+
+Recording is opt-in and rides on vultan.instrument's listeners:
+
+    recorder = vultan.advisor.QueryRecorder()
+    with recorder:
+        run_workload()
+    print vultan.advisor.advise(recorder, [User, PostStorage(Post)])
+
+A shape is a query with its values removed: which fields it tests and
+with which operators, its sort and its projection, all in mongodb field
+names, kept per "db.collection" namespace. Latencies are the operations'
+wall times; for cursors that are iterated lazily (iterfind, values,
+values_list) only the time to open the cursor is counted.
+
+Suggestions follow the usual rule for compound indexes: equality fields
+first, then the sort, then range fields. A declared index counts as used
+by a shape if its first field is one the shape tests (or, for a query
+without conditions, its first sort field), which is how require_index
+and the query optimizer pick candidates too.
+"""
+import collections
+import threading
+import vultan.instrument
+from vultan.document import Index
+
+# The operations whose shapes are recorded.
+RECORDED_OPERATIONS = set(['find', 'find_one', 'count', 'update', 'upsert',
+                           'remove'])
+
+_EQ = 'eq'
+_RANGE_OPS = set(['$gt', '$gte', '$lt', '$lte', '$ne', '$nin'])
+
+
+QueryShape = collections.namedtuple(
+    'QueryShape', 'collection operation conditions sort projection')
+
+
+class ShapeStats(object):
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.errors = 0
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.count if self.count else 0.0
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+        if error:
+            self.errors += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        self.errors += other.errors
+
+    def __repr__(self):
+        return '%s(count=%d, mean=%.6fs, max=%.6fs)' % (
+            self.__class__.__name__, self.count, self.mean_time, self.max_time)
+
+
+class QueryRecorder(object):
+    """Collects a ShapeStats per QueryShape while started (or while used as
+    a context manager)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shapes = {}
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            vultan.instrument.add_listener(self.record)
+            self._started = True
+
+    def stop(self):
+        if self._started:
+            vultan.instrument.remove_listener(self.record)
+            self._started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record(self, record):
+        """Adds a vultan.instrument.OperationRecord."""
+        if record.operation not in RECORDED_OPERATIONS or record.spec is None:
+            return
+        shape = QueryShape(record.namespace, record.operation,
+                           normalize_spec(record.spec),
+                           normalize_sort(record.sort),
+                           normalize_projection(record.fields))
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                stats = self._shapes[shape] = ShapeStats()
+            stats.add(record.wall_time, record.error is not None)
+
+    def shapes(self):
+        """Returns (QueryShape, ShapeStats) pairs, most total time first."""
+        with self._lock:
+            items = self._shapes.items()
+        return sorted(items, key=lambda item: -item[1].total_time)
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+
+
+def normalize_spec(spec):
+    """Returns a sorted tuple of (field, operators) pairs for an encoded
+    spec. Clauses of $or/$and/$nor are flattened into their fields."""
+    conditions = collections.defaultdict(set)
+    _collect_conditions(spec, conditions)
+    return tuple(sorted((field, tuple(sorted(ops)))
+                        for field, ops in conditions.iteritems()))
+
+
+def normalize_sort(sort):
+    if not sort:
+        return None
+    if isinstance(sort, basestring):
+        return ((sort, 1),)
+    return tuple((field, direction) for field, direction in sort)
+
+
+def normalize_projection(fields):
+    if not fields:
+        return None
+    if isinstance(fields, dict):
+        fields = [field for field, included in fields.iteritems() if included]
+    return tuple(sorted(fields))
+
+
+def _collect_conditions(spec, conditions):
+    for field, condition in spec.iteritems():
+        if field in ('$or', '$and', '$nor'):
+            for clause in condition:
+                _collect_conditions(clause, conditions)
+        elif isinstance(condition, dict) and condition and \
+                all(key.startswith('$') for key in condition):
+            conditions[field].update(condition)
+        else:
+            conditions[field].add(_EQ)
+
+
+class Suggestion(object):
+    """A compound index that would serve the recorded `shapes`."""
+    def __init__(self, collection, index):
+        self.collection = collection
+        self.index = index
+        self.shapes = []
+        self.stats = ShapeStats()
+
+    def absorb(self, shapes, stats):
+        self.shapes.extend(shapes)
+        self.stats.merge(stats)
+
+    def __str__(self):
+        return '%s: %s  # %d queries, %.3fs total' % (
+            self.collection, declaration(self.index), self.stats.count,
+            self.stats.total_time)
+
+
+class Advice(object):
+    def __init__(self, suggestions, unused):
+        self.suggestions = suggestions
+        self.unused = unused
+
+    def __str__(self):
+        lines = ['Suggested indexes:']
+        lines.extend('  %s' % suggestion for suggestion in self.suggestions)
+        lines.append('Unused indexes:')
+        for collection, key in self.unused:
+            lines.append('  %s: %s%s' % (
+                collection, declaration(key),
+                '  # still enforces uniqueness' if key.unique else ''))
+        return '\n'.join(lines)
+
+
+def advise(recorder, targets, min_count=1):
+    """Returns Advice for the document classes or storages in `targets`
+    from what `recorder` saw. Shapes seen fewer than `min_count` times are
+    ignored."""
+    declared = collections.defaultdict(list)
+    names = collections.defaultdict(lambda: {'_id': 'id'})
+    for target in targets:
+        target = getattr(target, 'DB', target)  # a NewDocument's storage
+        collection = target._get_collection().full_name
+        for name, _ in target._attributes:
+            names[collection][target._codec.dbname(name)] = name
+        for key in target._keys:
+            dbnames = [target._codec.dbname(name) for name in key.names]
+            if key.names != ['id'] and (key, dbnames) not in declared[collection]:
+                declared[collection].append((key, dbnames))
+
+    used = set()
+    suggestions = {}
+    for shape, stats in recorder.shapes():
+        if shape.collection not in names:
+            continue
+        indexes = declared[shape.collection]
+        for key, dbnames in indexes:
+            if _uses(shape, dbnames):
+                used.add((shape.collection, tuple(dbnames)))
+        ideal = tuple(_ideal_index(shape))
+        if stats.count < min_count or not ideal or ideal[0][0] == '_id' or \
+                any(_serves(dbnames, shape) for _, dbnames in indexes):
+            continue
+        suggestion = suggestions.get((shape.collection, ideal))
+        if suggestion is None:
+            index = Index(*[(names[shape.collection].get(dbname, dbname),
+                             direction) for dbname, direction in ideal])
+            suggestion = suggestions[shape.collection, ideal] = \
+                Suggestion(shape.collection, index)
+        suggestion.absorb([shape], stats)
+
+    # An index also serves the shapes of every index that is its prefix.
+    answer = []
+    for (collection, ideal), suggestion in suggestions.iteritems():
+        longer = [(len(key), other)
+                  for (other_collection, key), other in suggestions.iteritems()
+                  if other_collection == collection and
+                  len(key) > len(ideal) and _same_fields(key[:len(ideal)], ideal)]
+        if longer:
+            max(longer)[1].absorb(suggestion.shapes, suggestion.stats)
+        else:
+            answer.append(suggestion)
+    answer.sort(key=lambda suggestion: -suggestion.stats.total_time)
+
+    unused = [(collection, key)
+              for collection in sorted(declared)
+              for key, dbnames in declared[collection]
+              if (collection, tuple(dbnames)) not in used]
+    return Advice(answer, unused)
+
+
+def declaration(index):
+    """Returns the Python source that declares `index`."""
+    args = []
+    for name, direction in index.index:
+        args.append(repr(name) if direction == 1 else
+                    '(%r, %r)' % (name, direction))
+    return '%s(%s)' % (index.__class__.__name__, ', '.join(args))
+
+
+def _split(shape):
+    """Returns a shape's equality fields, sort pairs and range fields."""
+    eq = [field for field, ops in shape.conditions
+          if _EQ in ops or '$in' in ops or '$all' in ops]
+    sort = [(field, direction) for field, direction in shape.sort or ()
+            if field not in eq]
+    sorted_fields = set(field for field, _ in sort)
+    ranges = [field for field, ops in shape.conditions
+              if field not in eq and field not in sorted_fields and
+              _RANGE_OPS.intersection(ops)]
+    return eq, sort, ranges
+
+
+def _ideal_index(shape):
+    eq, sort, ranges = _split(shape)
+    return ([(field, 1) for field in eq] + sort +
+            [(field, 1) for field in ranges])
+
+
+def _same_fields(key, other):
+    return [field for field, _ in key] == [field for field, _ in other]
+
+
+def _uses(shape, dbnames):
+    fields = set(field for field, _ in shape.conditions)
+    if fields:
+        return dbnames[0] in fields
+    return bool(shape.sort) and shape.sort[0][0] == dbnames[0]
+
+
+def _serves(dbnames, shape):
+    """True if an index on `dbnames` leads with the shape's equality fields
+    (in any order) followed by its sort fields (in order)."""
+    eq, sort, ranges = _split(shape)
+    if set(dbnames[:len(eq)]) != set(eq):
+        return False
+    rest = dbnames[len(eq):]
+    if sort:
+        return rest[:len(sort)] == [field for field, _ in sort]
+    return not ranges or not rest or rest[0] in ranges
@@ -0,0 +1,204 @@
+"""Non-blocking front-end for SimpleStorage.
+
+Requires the concurrent.futures package (the "futures" backport on Python 2).
+Every operation returns a concurrent.futures.Future, which callers can wait
+on, attach callbacks to, or hand to an event loop (e.g. tornado's
+IOLoop.add_future, or asyncio.wrap_future).
+"""
+import collections
+import concurrent.futures
+import threading
+
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_BATCH_SIZE = 100
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def _get_default_executor():
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = concurrent.futures.ThreadPoolExecutor(
+                DEFAULT_MAX_WORKERS)
+        return _default_executor
+
+
+class _Limiter(object):
+    """Runs calls on an executor with at most `limit` in flight at a time.
+
+    Calls over the limit are queued without blocking the caller and are
+    submitted as earlier calls finish.
+    """
+    def __init__(self, executor, limit):
+        self._executor = executor
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._running = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._running >= self._limit:
+                self._pending.append((future, fn, args, kwargs))
+                return future
+            self._running += 1
+        if not self._start(future, fn, args, kwargs):
+            self._finish()
+        return future
+
+    def _start(self, future, fn, args, kwargs):
+        """Returns True if the call holds its slot until it is done, False
+        if `future` was cancelled or the executor refused the call (e.g.
+        after shutdown), in which case `future` is already resolved."""
+        if not future.set_running_or_notify_cancel():
+            return False
+        try:
+            inner = self._executor.submit(fn, *args, **kwargs)
+        except Exception as exception:
+            future.set_exception(exception)
+            return False
+        inner.add_done_callback(lambda inner: self._done(future, inner))
+        return True
+
+    def _done(self, future, inner):
+        try:
+            # `future` is already running, so it can't be cancelled itself.
+            if inner.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+        finally:
+            self._finish()
+
+    def _finish(self):
+        """Releases a slot, or hands it to the next pending call."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running -= 1
+                    return
+                future, fn, args, kwargs = self._pending.popleft()
+            if self._start(future, fn, args, kwargs):
+                return
+
+
+class AsyncCursor(object):
+    """Streams the documents of a query in batches.
+
+    next_batch() returns a Future of the next list of decoded documents; an
+    empty list means the results are exhausted. Documents are decoded on
+    the worker threads, so the caller's thread never blocks. pymongo
+    cursors aren't thread-safe, so each call on a cursor starts only once
+    the previous one has finished.
+    """
+    def __init__(self, limiter, cursor, batch_size):
+        self._limiter = limiter
+        self._cursor = cursor
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._last = None
+
+    def next_batch(self):
+        return self._chain(self._read_batch)
+
+    def close(self):
+        return self._chain(self._cursor.close)
+
+    def _chain(self, fn):
+        future = concurrent.futures.Future()
+        # Completes when fn has run (or was cancelled); unlike `future`, it
+        # can't be cancelled while fn is still running.
+        finished = concurrent.futures.Future()
+        with self._lock:
+            previous, self._last = self._last, finished
+
+        def start(_=None):
+            if not future.set_running_or_notify_cancel():
+                finished.set_result(None)
+                return
+            inner = self._limiter.submit(fn)
+            inner.add_done_callback(
+                lambda inner: self._done(future, finished, inner))
+
+        if previous is None:
+            start()
+        else:
+            previous.add_done_callback(start)
+        return future
+
+    def _done(self, future, finished, inner):
+        exception = inner.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(inner.result())
+        finished.set_result(None)
+
+    def _read_batch(self):
+        batch = []
+        for doc in self._cursor:
+            batch.append(doc)
+            if len(batch) == self._batch_size:
+                break
+        return batch
+
+
+class AsyncStorage(object):
+    """Mirrors SimpleStorage, running each operation on a thread pool.
+
+    At most `max_in_flight` operations for this storage run at once; the
+    rest wait in a queue. All instances share one thread pool unless an
+    `executor` is given.
+    """
+    def __init__(self, storage, executor=None,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self._storage = storage
+        self._limiter = _Limiter(executor or _get_default_executor(),
+                                 max_in_flight)
+
+    def find_one(self, **kwargs):
+        return self._limiter.submit(self._storage._find_one, kwargs)
+
+    def find(self, batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+        """Returns a Future of an AsyncCursor over the matching documents."""
+        def start():
+            cursor = self._storage._iterfind(kwargs, batch_size=batch_size)
+            return AsyncCursor(self._limiter, cursor, batch_size)
+        return self._limiter.submit(start)
+
+    def exists(self, **kwargs):
+        return self._limiter.submit(self._storage._exists, kwargs)
+
+    def count(self, **kwargs):
+        return self._limiter.submit(self._storage._count, kwargs)
+
+    def insert(self, **kwargs):
+        return self._limiter.submit(self._storage._insert, kwargs)
+
+    def upsert(self, query, **kwargs):
+        return self._limiter.submit(self._storage._upsert, query, kwargs)
+
+    def update_one(self, query, **kwargs):
+        return self._limiter.submit(self._storage._update, query, kwargs,
+                                    multi=False)
+
+    def update(self, query, **kwargs):
+        return self._limiter.submit(self._storage._update, query, kwargs,
+                                    multi=True)
+
+    def set_one(self, query, **kwargs):
+        return self._limiter.submit(self._storage._update, query,
+                                    {'$set': kwargs}, multi=False)
+
+    def set(self, query, **kwargs):
+        return self._limiter.submit(self._storage._update, query,
+                                    {'$set': kwargs}, multi=True)
+
+    def remove(self, **kwargs):
+        return self._limiter.submit(self._storage._remove, kwargs)
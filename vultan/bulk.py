@@ -0,0 +1,226 @@
+import bson
+import bson.son
+import pymongo.errors
+import vultan.errors
+
+INSERT_CHUNK_SIZE = 1000
+INSERT_CHUNK_BYTES = 4 * 1024 * 1024
+
+# The server's limit on operations per write command, and a size that keeps
+# a command well under its 16MB limit.
+WRITE_BATCH_SIZE = 1000
+WRITE_BATCH_BYTES = 4 * 1024 * 1024
+
+
+class InsertResult(object):
+    """The outcome of insert_many.
+
+    `ids` holds the ids of the documents in every chunk that was accepted.
+    `errors` holds an (offset, count, exception) triple for each chunk the
+    server rejected, where offset is the position of the chunk's first
+    document in the input, and an (offset, 1, exception) triple for each
+    document that failed validation or encoding. Some documents of a
+    rejected chunk may still have been inserted.
+    """
+    def __init__(self):
+        self.ids = []
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return '%s(%d ids, %d errors)' % (self.__class__.__name__,
+                                          len(self.ids), len(self.errors))
+
+
+def insert_many(collection, docs, encode, required_names, ordered=True,
+                chunk_size=INSERT_CHUNK_SIZE, chunk_bytes=INSERT_CHUNK_BYTES,
+                sent=None):
+    """Inserts an iterable of documents in chunks of at most `chunk_size`
+    documents and about `chunk_bytes` bytes of BSON.
+
+    Documents are validated and encoded as they are consumed, so the input
+    may be a generator. A document that fails is recorded in the result and
+    the documents before it are still sent. In ordered mode, the first
+    failure (or rejected chunk) stops the load; otherwise every chunk is
+    sent with continue_on_error. If given, `sent` is called with each
+    chunk's encoded documents once the chunk has been sent (or has failed).
+    """
+    result = InsertResult()
+    for offset, chunk, exception in _encoded_chunks(
+            docs, encode, required_names, chunk_size, chunk_bytes):
+        if exception is not None:
+            result.errors.append((offset, 1, exception))
+            if ordered:
+                break
+            continue
+        try:
+            ids = collection.insert(chunk, safe=True,
+                                    continue_on_error=not ordered)
+        except pymongo.errors.OperationFailure, exception:
+            result.errors.append((offset, len(chunk), exception))
+            if ordered:
+                break
+        else:
+            result.ids.extend(str(object_id) for object_id in ids)
+        finally:
+            if sent is not None:
+                sent(chunk)
+    return result
+
+
+def _encoded_chunks(docs, encode, required_names, chunk_size, chunk_bytes):
+    """Yields (offset, chunk, None) for each chunk of encoded documents and
+    (offset, None, exception) for each document that can't be encoded. A
+    failure ends the chunk before it, so chunks hold consecutive input."""
+    chunk = []
+    size = 0
+    start = 0
+    for index, doc in enumerate(docs):
+        try:
+            if not required_names.issubset(doc):
+                raise vultan.errors.KeyMatchError(doc)
+            doc = encode(doc)
+            doc_size = len(bson.BSON.encode(doc))
+        except Exception, exception:
+            if chunk:
+                yield start, chunk, None
+                chunk = []
+                size = 0
+            yield index, None, exception
+            start = index + 1
+            continue
+        if chunk and (len(chunk) == chunk_size or size + doc_size > chunk_bytes):
+            yield start, chunk, None
+            chunk = []
+            size = 0
+            start = index
+        chunk.append(doc)
+        size += doc_size
+    if chunk:
+        yield start, chunk, None
+
+
+class WriteResult(object):
+    """The outcome of bulk_update.
+
+    `matched`, `modified` and `upserted` are totals over every batch, and
+    `upserted_ids` maps operation indexes to the ids of inserted documents.
+    `errors` holds an (index, exception) pair for each operation that
+    failed validation or was rejected by the server; server rejections are
+    pymongo OperationFailures. A batch the server fails as a whole is
+    recorded against its first operation, and stops the run. On servers
+    without write commands, `modified` counts every matched document.
+    """
+    def __init__(self):
+        self.matched = 0
+        self.modified = 0
+        self.upserted = 0
+        self.upserted_ids = {}
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return '%s(matched=%d, modified=%d, upserted=%d, %d errors)' % (
+            self.__class__.__name__, self.matched, self.modified,
+            self.upserted, len(self.errors))
+
+
+def bulk_update(collection, operations, encode, upsert=False, ordered=True,
+                batch_size=WRITE_BATCH_SIZE, sent=None,
+                batch_bytes=WRITE_BATCH_BYTES):
+    """Applies an iterable of single-document updates in batches of at
+    most `batch_size` operations and about `batch_bytes` bytes of BSON,
+    sending each batch as one "update" write command.
+
+    `encode` turns each operation into a (spec, document) pair or raises,
+    in which case the error is recorded against the operation's index. In
+    ordered mode, the first error stops the run. If given, `sent` is called
+    with each batch's specs once the batch has been sent (or has failed).
+    """
+    result = WriteResult()
+    batch = []
+    size = 0
+    for index, operation in enumerate(operations):
+        try:
+            spec, document = encode(operation)
+            operation_size = len(bson.BSON.encode({'q': spec, 'u': document}))
+        except Exception, exception:
+            result.errors.append((index, exception))
+            if ordered:
+                break
+            continue
+        if batch and (len(batch) == batch_size or
+                      size + operation_size > batch_bytes):
+            if not _send_batch(collection, batch, upsert, ordered, result,
+                               sent):
+                return result
+            batch = []
+            size = 0
+        batch.append((index, spec, document))
+        size += operation_size
+    if batch:
+        _send_batch(collection, batch, upsert, ordered, result, sent)
+    return result
+
+
+def _send_batch(collection, batch, upsert, ordered, result, sent):
+    try:
+        return _send_updates(collection, batch, upsert, ordered, result)
+    finally:
+        if sent is not None:
+            sent([spec for _, spec, _ in batch])
+
+
+def _send_updates(collection, batch, upsert, ordered, result):
+    """Sends one batch. Returns False if an ordered run must stop."""
+    updates = [{'q': spec, 'u': document, 'upsert': upsert, 'multi': False}
+               for _, spec, document in batch]
+    command = bson.son.SON([('update', collection.name),
+                            ('updates', updates),
+                            ('ordered', ordered)])
+    try:
+        response = collection.database.command(command)
+    except pymongo.errors.OperationFailure, exception:
+        if 'no such c' in str(exception):
+            return _send_updates_one_by_one(collection, batch, upsert,
+                                            ordered, result)
+        result.errors.append((batch[0][0], exception))
+        return False
+
+    upserted = response.get('upserted', [])
+    result.matched += response.get('n', 0) - len(upserted)
+    result.modified += response.get('nModified', 0)
+    result.upserted += len(upserted)
+    for item in upserted:
+        result.upserted_ids[batch[item['index']][0]] = str(item['_id'])
+    for error in response.get('writeErrors', []):
+        result.errors.append((batch[error['index']][0],
+                              pymongo.errors.OperationFailure(
+                                  error.get('errmsg'), error.get('code'))))
+    return not (ordered and response.get('writeErrors'))
+
+
+def _send_updates_one_by_one(collection, batch, upsert, ordered, result):
+    """Fallback for servers that predate write commands (MongoDB < 2.6)."""
+    for index, spec, document in batch:
+        try:
+            response = collection.update(spec, document, upsert=upsert,
+                                         multi=False, safe=True)
+        except pymongo.errors.OperationFailure, exception:
+            result.errors.append((index, exception))
+            if ordered:
+                return False
+            continue
+        if response.get('updatedExisting'):
+            result.matched += response['n']
+            result.modified += response['n']
+        elif 'upserted' in response:
+            result.upserted += 1
+            result.upserted_ids[index] = str(response['upserted'])
+    return True
@@ -0,0 +1,133 @@
+import collections
+import threading
+import time
+
+
+class DocumentCache(object):
+    """A size-bounded LRU cache of documents with optional TTL expiry.
+
+    Entries are also indexed by (dbname, value) pairs taken from the cached
+    document's key fields, so that a write can invalidate every entry for
+    the documents it may have touched, whichever key they were cached under.
+
+    Each invalidation is numbered. A reader takes a snapshot() before it
+    reads and passes it to put(), which skips the document if any of its
+    pairs was invalidated since, since the read may predate the write.
+    """
+    def __init__(self, max_size=1000, ttl=None, clock=time.time):
+        assert max_size > 0
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._index = collections.defaultdict(set)
+        # The number of the latest invalidation, that of each recently
+        # invalidated pair, and the latest clear() (or forgetting of pairs).
+        self._sequence = 0
+        self._invalidated = {}
+        self._floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the cached document for `key`, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            doc, pairs, expires = entry
+            if expires is not None and expires <= self._clock():
+                self._unindex(key, pairs)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # move to the most-recent end
+            self.hits += 1
+            return doc
+
+    def snapshot(self):
+        """Returns a token to pass to put() for a document read after this
+        call."""
+        with self._lock:
+            return self._sequence
+
+    def put(self, key, doc, pairs, snapshot=None):
+        """Caches `doc` under `key`. `pairs` are the (dbname, value) pairs
+        by which the entry can later be invalidated. Returns False, caching
+        nothing, if any of them was invalidated after `snapshot`."""
+        expires = self._clock() + self._ttl if self._ttl else None
+        with self._lock:
+            if snapshot is not None and self._is_stale(pairs, snapshot):
+                return False
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._unindex(key, old[1])
+            self._entries[key] = (doc, pairs, expires)
+            for pair in pairs:
+                self._index[pair].add(key)
+            while len(self._entries) > self._max_size:
+                oldest, (_, old_pairs, _) = self._entries.popitem(last=False)
+                self._unindex(oldest, old_pairs)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, pairs):
+        """Drops every entry indexed under any of `pairs`."""
+        with self._lock:
+            self._sequence += 1
+            if len(self._invalidated) >= self._max_size:
+                # Forget old pairs; snapshots older than now go stale.
+                self._invalidated.clear()
+                self._floor = self._sequence
+            for pair in pairs:
+                self._invalidated[pair] = self._sequence
+                for key in list(self._index.get(pair, ())):
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._unindex(key, entry[1])
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._sequence += 1
+            self._invalidated.clear()
+            self._floor = self._sequence
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._index.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._entries), hits=self.hits,
+                        misses=self.misses, evictions=self.evictions,
+                        expirations=self.expirations,
+                        invalidations=self.invalidations)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_stale(self, pairs, snapshot):
+        if snapshot < self._floor:
+            return True
+        return any(self._invalidated.get(pair, 0) > snapshot for pair in pairs)
+
+    def _unindex(self, key, pairs):
+        for pair in pairs:
+            keys = self._index.get(pair)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[pair]
+
+
+def hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
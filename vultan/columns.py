@@ -0,0 +1,56 @@
+"""Columnar export of query results. Requires numpy."""
+import numpy
+import vultan.types
+
+# Maps field types to the numpy dtype of their columns and the placeholder
+# stored under the mask for missing values. Other fields become objects.
+_DTYPES = [
+    (vultan.types.BoolField, numpy.bool_, False),
+    (vultan.types.IntField, numpy.int64, 0),
+    (vultan.types.FloatField, numpy.float64, numpy.nan),
+    (vultan.types.DatetimeField, 'datetime64[us]', None),
+]
+
+
+def _get_dtype(fieldtype):
+    for cls, dtype, fill in _DTYPES:
+        if isinstance(fieldtype, cls):
+            return dtype, fill
+    return object, None
+
+
+class _Column(object):
+    def __init__(self, dbname, fieldtype):
+        self.dbname = dbname
+        self.decode = fieldtype.from_mongo
+        self.dtype, self.fill = _get_dtype(fieldtype)
+        self.values = []
+        self.mask = []
+
+    def append(self, raw):
+        value = self.decode(raw) if raw is not None else None
+        if value is None:
+            self.values.append(self.fill)
+            self.mask.append(True)
+        else:
+            self.values.append(value)
+            self.mask.append(False)
+
+    def to_array(self):
+        return numpy.ma.masked_array(
+            numpy.array(self.values, dtype=self.dtype),
+            mask=numpy.array(self.mask, dtype=numpy.bool_))
+
+
+def build_columns(docs, codec, attributes, names):
+    """Decodes the `names` attributes of raw mongodb documents into a dict
+    of numpy masked arrays, masking values that are absent or undecodable.
+    """
+    identity = vultan.types.IdentityField()
+    columns = [(name, _Column(codec.dbname(name),
+                              attributes.get_fieldtype(name) or identity))
+               for name in names]
+    for doc in docs:
+        for _, column in columns:
+            column.append(doc.get(column.dbname))
+    return dict((name, column.to_array()) for name, column in columns)
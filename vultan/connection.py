@@ -0,0 +1,132 @@
+import os
+import threading
+import pymongo
+import vultan.errors
+import vultan.memory
+
+DEFAULT_ALIAS = 'default'
+
+_lock = threading.RLock()
+_settings = {}
+_connections = {}
+_pid = None
+
+
+def _connect_pymongo(settings):
+    if 'replicaSet' in settings['options']:
+        hosts = settings['host']
+        if settings['port'] is not None:
+            hosts = '%s:%d' % (hosts, settings['port'])
+        return pymongo.ReplicaSetConnection(
+            hosts, max_pool_size=settings['max_pool_size'],
+            **settings['options'])
+    return pymongo.Connection(settings['host'], settings['port'],
+                              max_pool_size=settings['max_pool_size'],
+                              **settings['options'])
+
+
+def _connect_memory(settings):
+    return vultan.memory.MemoryConnection()
+
+
+_backends = {'pymongo': _connect_pymongo, 'memory': _connect_memory}
+
+
+def register(alias=DEFAULT_ALIAS, host='localhost', port=None, db='test',
+             max_pool_size=10, backend='pymongo', **options):
+    """Registers connection settings under `alias`.
+
+    No connection is made until the alias is first used, so it is safe to
+    call this in a pre-forking server's parent process. Any extra keyword
+    arguments are passed through to pymongo.Connection, or, if they include
+    `replicaSet`, to pymongo.ReplicaSetConnection (give `host` as
+    "host1:port1,host2:port2"). Re-registering an alias discards its
+    existing connection.
+
+    `backend` names the kind of connection to make: "pymongo" (a server),
+    "memory" (vultan.memory's in-process collections, whose contents last
+    until the alias is disconnected), or one added with register_backend.
+    """
+    if backend not in _backends:
+        raise vultan.errors.UnknownBackendError(backend)
+    with _lock:
+        _settings[alias] = dict(host=host, port=port, db=db,
+                                max_pool_size=max_pool_size, backend=backend,
+                                options=options)
+        _discard(alias)
+
+
+def register_backend(name, connect):
+    """Makes `name` usable as register()'s `backend`. `connect` is called
+    with an alias's settings dict (host, port, db, max_pool_size, options)
+    and returns an object that maps database names to pymongo-compatible
+    databases and has a disconnect() method."""
+    with _lock:
+        _backends[name] = connect
+
+
+def get_connection(alias=DEFAULT_ALIAS):
+    """Returns the shared connection (usually a pymongo.Connection) for
+    `alias`.
+
+    Connections are created lazily and cached for the life of the process.
+    If the process has forked since the connection was made, the inherited
+    connection is abandoned (its sockets belong to the parent) and a fresh
+    one is created.
+    """
+    with _lock:
+        _check_pid()
+        connection = _connections.get(alias)
+        if connection is None:
+            settings = _get_settings(alias)
+            connection = _backends[settings['backend']](settings)
+            _connections[alias] = connection
+        return connection
+
+
+def get_database(alias=DEFAULT_ALIAS):
+    """Returns the database registered under `alias`."""
+    return get_connection(alias)[_get_settings(alias)['db']]
+
+
+def disconnect(alias=None):
+    """Closes the connection for `alias`, or for every alias if None.
+
+    The settings are kept, so the next use of the alias reconnects.
+    """
+    with _lock:
+        for name in ([alias] if alias else _connections.keys()):
+            connection = _connections.pop(name, None)
+            if connection is not None:
+                connection.disconnect()
+
+
+#
+# private functions
+#
+
+def _get_settings(alias):
+    with _lock:
+        if alias not in _settings:
+            if alias != DEFAULT_ALIAS:
+                raise vultan.errors.UnregisteredConnectionError(alias)
+            register(DEFAULT_ALIAS)
+        return _settings[alias]
+
+
+def _discard(alias):
+    connection = _connections.pop(alias, None)
+    if connection is not None and _pid == os.getpid():
+        connection.disconnect()
+
+
+def _check_pid():
+    global _pid
+    pid = os.getpid()
+    if _pid != pid:
+        # In-memory connections hold no sockets, and their data is the
+        # child's copy, so they carry over.
+        for alias, connection in _connections.items():
+            if not isinstance(connection, vultan.memory.MemoryConnection):
+                del _connections[alias]
+        _pid = pid
@@ -1,7 +1,12 @@
 import collections
 import pymongo
 import pymongo.errors
+import vultan.bulk
+import vultan.connection
 import vultan.errors
+import vultan.indexes
+import vultan.instrument
+import vultan.routing
 import vultan.types
 
 
@@ -30,6 +35,10 @@ class Index(object):
     def match(self, query, unique=False):
         return query
 
+    def covers(self, names, unique=False):
+        """Returns True if a query on the fields `names` can use this."""
+        return self.head in names
+
     def __eq__(self, other):
         if not isinstance(other, Index):
             return False
@@ -43,17 +52,27 @@ class Key(Index):
     unique = True
 
     def match(self, query, unique=False):
-        if unique:
-            for name in self.names:
-                assert name in query
-        else:
-            assert self.head in query
+        if not self.covers(query, unique):
+            raise vultan.errors.KeyMatchError(
+                '%r does not match fields %s' % (self, sorted(query)))
         return query
 
+    def covers(self, names, unique=False):
+        if unique:
+            return all(name in names for name in self.names)
+        return self.head in names
+
+
+# Bounds the number of query shapes a _KeySet remembers matches for.
+MAX_MATCH_PLANS = 1000
+
+_NO_PLAN = object()
+
 
 class _KeySet(object):
     def __init__(self, *args):
         self._keys = collections.defaultdict(list)
+        self._plans = {}
         self.names = set()
         self.update(args)
         self.add(Key('id'))
@@ -63,6 +82,7 @@ class _KeySet(object):
             self._keys[key.head].append(key)
             for name in key.names:
                 self.names.add(name)
+            self._plans.clear()
 
     def update(self, keys):
         for key in keys:
@@ -77,22 +97,260 @@ class _KeySet(object):
     def contains(self, name):
         return name in self.names
 
+    def unique_names(self):
+        """Returns the names every inserted document must have: those of
+        the unique keys other than the builtin "id" key."""
+        return set(name for key in self if key.unique and key.head != 'id'
+                   for name in key.names)
+
+    def find(self, names, unique=False):
+        """Returns a key in this set that a query on the fields `names` can
+        use (a unique one, with all its fields present, if `unique`), or
+        None. Answers are remembered per set of names."""
+        shape = (frozenset(names), unique)
+        key = self._plans.get(shape, _NO_PLAN)
+        if key is _NO_PLAN:
+            key = self._plan(shape[0], unique)
+            if len(self._plans) >= MAX_MATCH_PLANS:
+                self._plans.clear()
+            self._plans[shape] = key
+        return key
+
     def match(self, query, unique=False):
-        """Tries to match any key in this set."""
-        for head in query.iterkeys():
-            for key in self._keys.get(head, []):
-                try:
-                    return key.match(query, unique)
-                except:
-                    pass
-        print 'query keys = ', query.keys()
-        print 'self._keys = ', self._keys
-        raise vultan.errors.KeyMatchError(query)
+        """Returns `query` if it can use a key in this set; otherwise raises
+        KeyMatchError."""
+        if self.find(query, unique) is None:
+            raise vultan.errors.KeyMatchError(self._describe(query, unique))
+        return query
+
+    def _plan(self, names, unique):
+        for name in names:
+            for key in self._keys.get(name, ()):
+                if key.covers(names, unique):
+                    return key
+        return None
+
+    def plan_declared_shapes(self):
+        """Plans the query shapes of the declared keys up front. Adding a
+        key forgets every plan, so call this once the set is complete."""
+        for key in list(self):
+            for names in (key.names, [key.head]):
+                self.find(names, False)
+                self.find(names, True)
+
+    def _describe(self, query, unique):
+        return 'no %s matches fields %s; declared: %s' % (
+            'unique key' if unique else 'key or index', sorted(query),
+            ', '.join(sorted(repr(key) for key in self)))
 
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__, self._keys)
 
 
+# MongoDB refuses to index values larger than 1KB, so this many key values
+# keep an $in query well under even the old 4MB BSON document limit.
+IN_CHUNK_SIZE = 1000
+
+
+def _chunks(seq, size):
+    chunk = []
+    for item in seq:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _encoded_values(encode, values):
+    """Maps each encoded value to the list of caller values it came from."""
+    originals = collections.defaultdict(list)
+    for value in values:
+        originals[encode(value)].append(value)
+    return originals
+
+
+def _find_by_values(target, name, values, fields, chunk_size):
+    """Looks up documents of `target`, a document class or storage, by many
+    values of its key attribute `name`. Returns a dict mapping each value to
+    its document, or to None if no document has that value. Each value is
+    encoded once; each `chunk_size` of them cost one $in query."""
+    target._keys.match({name: values}, unique=True)
+    dbname = target._codec.dbname(name)
+    originals = _encoded_values(target._codec.encoder(name), values)
+    projection = target._fields_to_mongo(target._add_key_fields(fields))
+    collection = target._get_collection()
+    answer = dict.fromkeys(values)
+    for chunk in _chunks(originals.iterkeys(), chunk_size):
+        cursor = collection.find(spec={dbname: {'$in': chunk}},
+                                 fields=projection, **target._read_options())
+        for doc in cursor:
+            for value in originals.get(doc.get(dbname), ()):
+                answer[value] = target._construct(doc, fields)
+    return answer
+
+
+def _found_values(docs, dbname, originals):
+    found = set()
+    for doc in docs:
+        value = doc.get(dbname)
+        for item in (value if isinstance(value, list) else [value]):
+            found.update(originals.get(item, ()))
+    return found
+
+
+class _DocumentCursor(object):
+    """Wraps a pymongo cursor, constructing documents one at a time.
+
+    Call close() (or use a with block) when abandoning the iteration early,
+    so that the server-side cursor is released promptly.
+    """
+    def __init__(self, cursor, construct):
+        self._cursor = cursor
+        self._construct = construct
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            doc = self._cursor.next()
+        except StopIteration:
+            self.close()
+            raise
+        return self._construct(doc)
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _LazyField(object):
+    """Decodes an attribute from a document's raw data on first access.
+
+    The decoded value is stored in the instance's __dict__, which shadows
+    this (non-data) descriptor, so later reads cost nothing extra.
+    """
+    def __init__(self, name, fieldtype):
+        self._name = name
+        self._fieldtype = fieldtype
+        self._dbname = fieldtype.get_dbname(name)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self._decode(instance)
+        instance.__dict__[self._name] = value
+        return value
+
+    def _decode(self, instance):
+        if self._name in instance._missing:
+            raise vultan.errors.MissingAttributeError(self._name)
+        return self._fieldtype.from_mongo(instance._data.get(self._dbname))
+
+
+class _LazySlotField(_LazyField):
+    """A _LazyField for slotted classes, caching the decoded value in the
+    attribute's slot instead of the instance's __dict__."""
+    def __init__(self, name, fieldtype, slot):
+        super(_LazySlotField, self).__init__(name, fieldtype)
+        self._slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return self._slot.__get__(instance, owner)
+        except AttributeError:
+            value = self._decode(instance)
+            self._slot.__set__(instance, value)
+            return value
+
+    def __set__(self, instance, value):
+        self._slot.__set__(instance, value)
+
+    def __delete__(self, instance):
+        self._slot.__delete__(instance)
+
+
+_SlotType = type(type('_Slotted', (object,), {'__slots__': ['x']}).x)
+
+
+def _find_slot(cls, name):
+    for klass in cls.__mro__:
+        slot = klass.__dict__.get(name)
+        if isinstance(slot, _LazySlotField):
+            return slot._slot
+        if isinstance(slot, _SlotType):
+            return slot
+    return None
+
+
+def _get_missing(document):
+    # Bypasses __getattr__, so lookups on a partly built instance (e.g.
+    # while unpickling) can't recurse.
+    try:
+        return object.__getattribute__(document, '_missing')
+    except AttributeError:
+        return ()
+
+
+def _install_lazy_fields(cls):
+    """Replaces eager attribute extraction with _LazyField descriptors if
+    the class sets _lazy = True."""
+    if cls._lazy:
+        assert cls._keep_data, 'lazy documents need their raw data'
+        for name, fieldtype in cls._attributes:
+            slot = _find_slot(cls, name)
+            if slot is not None:
+                setattr(cls, name, _LazySlotField(name, fieldtype, slot))
+            else:
+                setattr(cls, name, _LazyField(name, fieldtype))
+
+
+def _add_slots(classdict, bases, attrs):
+    """If the class sets (or inherits) _slots = True, gives it a slot per
+    attribute plus the document's own bookkeeping, so that instances need
+    no __dict__. Attributes declared with references() also get
+    `<name>_doc` and `<name>_docs` slots for prefetch() to fill. Slots
+    already defined by a base are not repeated. Instances still get a
+    __dict__ if any base document class is not slotted."""
+    slotted = classdict.get('_slots',
+                            any(getattr(base, '_slots', False) for base in bases))
+    if not slotted or '__slots__' in classdict:
+        return
+    inherited = set()
+    for base in bases:
+        for klass in base.__mro__:
+            inherited.update(klass.__dict__.get('__slots__', ()))
+    names = [name for name, _ in attrs] + ['_data', '_expected', '_missing']
+    for name, fieldtype in attrs:
+        # Not get_references(): the referenced class may not exist yet.
+        if getattr(fieldtype, '_references', None) is not None:
+            names.extend([name + '_doc', name + '_docs'])
+    classdict['__slots__'] = tuple(name for name in names
+                                   if name not in inherited)
+
+
+def _peek(document, name):
+    """Returns a document attribute's value without decoding it, raising
+    AttributeError if it hasn't been set (or decoded) yet."""
+    descriptor = getattr(type(document), name, None)
+    if isinstance(descriptor, _LazySlotField):
+        return descriptor._slot.__get__(document, type(document))
+    if name in getattr(document, '__dict__', ()):
+        return document.__dict__[name]
+    if isinstance(descriptor, _SlotType):
+        return descriptor.__get__(document, type(document))
+    raise AttributeError(name)
+
+
 class _Attributes(object):
     def __init__(self, dct):
         self._dct = dct
@@ -118,6 +376,172 @@ class _Attributes(object):
         return self._dct.iteritems()
 
 
+_CONTEXTS = ['AUTO', 'NONE', 'MANY', 'ATOM', 'LIST']
+
+_QUERY_OP_CONTEXTS = {
+    '$gt': 'AUTO', '$lt': 'AUTO', '$gte': 'AUTO', '$lte': 'AUTO', '$ne': 'AUTO',
+    '$in': 'MANY', '$nin': 'MANY',
+}
+
+# None means the operator's values are renamed but not transformed.
+_UPDATE_OP_CONTEXTS = {
+    '$set': 'AUTO', '$unset': None,
+    '$push': 'ATOM', '$pull': 'ATOM',
+    '$pushAll': 'LIST', '$pullAll': 'LIST',
+    '$inc': None, '$pop': None,
+}
+
+
+class _Codec(object):
+    """Converts between attribute dicts and mongodb documents for one class.
+
+    Built once per document class from its _Attributes: dbnames are resolved
+    and each field's to_mongo is specialized for every transform context, so
+    encoding a document costs one dict probe and one call per key. Queries
+    and updates look their encoders up by operator in tables built here too.
+    """
+    def __init__(self, attributes):
+        self._dbnames = {}
+        self._encoders = dict((context, {}) for context in _CONTEXTS)
+        self._identity = {}
+        self._decoders = {}
+        self.decoders = []
+        identity = vultan.types.IdentityField()
+        for context in _CONTEXTS:
+            self._identity[context] = identity.encoder(context)
+        for name, fieldtype in attributes:
+            dbname = fieldtype.get_dbname(name)
+            self._dbnames[name] = dbname
+            for context in _CONTEXTS:
+                self._encoders[context][name] = fieldtype.encoder(context)
+            self._decoders[name] = fieldtype.from_mongo
+            self.decoders.append((name, dbname, fieldtype.from_mongo))
+        # name -> {query operator: encoder}, with None for plain values
+        self._query_encoders = dict(
+            (name, self._operator_encoders(self._encoders, name))
+            for name in self._dbnames)
+        self._identity_query = self._operator_encoders(
+            dict((context, {None: encode})
+                 for context, encode in self._identity.iteritems()), None)
+        # update operator -> (context, {name: encoder}); None only renames
+        self._update_encoders = dict(
+            (op, (context, self._encoders.get(context)))
+            for op, context in _UPDATE_OP_CONTEXTS.iteritems())
+
+    def dbname(self, name):
+        try:
+            return self._dbnames[name]
+        except KeyError:
+            return self._check_unknown(name)
+
+    def encoder(self, name, context='AUTO'):
+        try:
+            return self._encoders[context][name]
+        except KeyError:
+            if context not in self._encoders:
+                raise vultan.errors.InvalidTransformContextError(context)
+            self._check_unknown(name)
+            return self._identity[context]
+
+    def decoder(self, name):
+        try:
+            return self._decoders[name]
+        except KeyError:
+            self._check_unknown(name)
+            return self._identity['AUTO']
+
+    def projection(self, names):
+        """Returns a mongodb field specification that fetches only `names`."""
+        projection = dict((self.dbname(name), True) for name in names)
+        projection.setdefault('_id', False)
+        return projection
+
+    def encode(self, doc, context='AUTO'):
+        """Transforms and renames every attribute in `doc`."""
+        try:
+            encoders = self._encoders[context]
+        except KeyError:
+            raise vultan.errors.InvalidTransformContextError(context)
+        dbnames = self._dbnames
+        answer = {}
+        for key, value in doc.iteritems():
+            encode = encoders.get(key)
+            if encode is None:
+                answer[self._check_unknown(key)] = \
+                    self._identity[context](value)
+            else:
+                answer[dbnames[key]] = encode(value)
+        return answer
+
+    def rename(self, doc):
+        """Renames every attribute in `doc` without transforming values."""
+        dbname = self.dbname
+        return dict((dbname(key), value) for key, value in doc.iteritems())
+
+    def encode_query(self, doc):
+        dbnames = self._dbnames
+        query_encoders = self._query_encoders
+        answer = {}
+        for key, value in doc.iteritems():
+            encoders = query_encoders.get(key)
+            if encoders is None:
+                dbname = self._check_unknown(key)
+                encoders = self._identity_query
+            else:
+                dbname = dbnames[key]
+            if isinstance(value, dict) and \
+                    all(op[:1] == '$' for op in value):
+                dct = {}
+                for op, val in value.iteritems():
+                    try:
+                        dct[op] = encoders[op](val)
+                    except KeyError:
+                        if op not in encoders:
+                            raise vultan.errors.UnsupportedMongodbOpError(op)
+                        raise
+                answer[dbname] = dct
+            else:
+                answer[dbname] = encoders[None](value)
+        return answer
+
+    def encode_update(self, doc):
+        dbnames = self._dbnames
+        answer = {}
+        for key, value in doc.iteritems():
+            try:
+                context, encoders = self._update_encoders[key]
+            except KeyError:
+                if key.startswith('$'):
+                    raise vultan.errors.UnsupportedMongodbOpError(key)
+                answer[self.dbname(key)] = self.encoder(key, 'AUTO')(value)
+                continue
+            dct = answer[key] = {}
+            for name, val in value.iteritems():
+                if name in dbnames:
+                    if encoders is not None:
+                        val = encoders[name](val)
+                    dct[dbnames[name]] = val
+                elif encoders is None:
+                    dct[self._check_unknown(name)] = val
+                else:
+                    dct[self._check_unknown(name)] = \
+                        self._identity[context](val)
+        return answer
+
+    @staticmethod
+    def _operator_encoders(encoders, name):
+        answer = dict((op, encoders[context][name])
+                      for op, context in _QUERY_OP_CONTEXTS.iteritems())
+        answer[None] = encoders['NONE'][name]
+        return answer
+
+    def _check_unknown(self, name):
+        """Unknown dotted names pass through untouched; others are errors."""
+        if '.' in name:
+            return name
+        raise vultan.errors.UnrecognizedAttributeError(name)
+
+
 class _DocumentMetaclass(type):
     def __new__(meta, classname, bases, classdict):
         # Rename some keys to indicate that they're "private"
@@ -130,6 +554,7 @@ class _DocumentMetaclass(type):
         for base in bases:
             if hasattr(base, '_keys'):
                 keys.update(base._keys)
+        keys.plan_declared_shapes()
         classdict['_keys'] = keys
 
         # Add the base classes' attributes to our own
@@ -138,56 +563,52 @@ class _DocumentMetaclass(type):
             if hasattr(base, '_attributes'):
                 attrs.update(base._attributes)
         classdict['_attributes'] = attrs
+        classdict['_codec'] = _Codec(attrs)
+        _add_slots(classdict, bases, attrs)
 
-        return type.__new__(meta, classname, bases, classdict)
+        newtype = type.__new__(meta, classname, bases, classdict)
+        _install_lazy_fields(newtype)
+        return newtype
 
 
 class ReadOnlyDocument(object):
     __metaclass__ = _DocumentMetaclass
+    __slots__ = ()
+    _connection = vultan.connection.DEFAULT_ALIAS
+    _read_preference = None  # see vultan.routing; None reads the primary
+    _lazy = False
+    _slots = False
+    _keep_data = True
 
     def __init__(self, data, expected):
         self._data = data
         self._expected = expected
         self._missing = []
-        for name, fieldtype in self._attributes:
-            self._extract(name, fieldtype)
+        for name, dbname, decode in self._codec.decoders:
+            self._extract(name, dbname, decode)
+        if not self._keep_data:
+            self._data = None
 
     def __getattr__(self, name):
-        if name in self._missing:
+        if name in _get_missing(self):
             raise vultan.errors.MissingAttributeError(name)
         raise AttributeError(name)
 
     def __repr__(self):
-        data = self.__dict__.copy()
-        for k in data.keys():
-            if k.startswith('_'):
-                del data[k]
+        data = dict((name, getattr(self, name)) for name, _ in self._attributes
+                    if name not in self._missing)
         return '%s(%s)' % (self.__class__.__name__, data)
 
     @classmethod
-    def create_indexes(cls):
-        """Ensures that only required indexes exist."""
-        created = []
-        for key in (key for key in cls._keys if key.names != ['id']):
-            key_or_list = [(cls._attributes.get_dbname(name), direction)
-                           for name, direction in key.index]
-            created.append(cls._get_collection().create_index(
-                    key_or_list, unique=key.unique))
-
-        indexes = cls._get_collection().index_information()
-        missing = list(set(created) - set(indexes.keys()))
-        if missing:
-            raise vultan.errors.CreateIndexError(cls._get_collection(), missing)
-
-        dropped = []
-        for name, spec in indexes.iteritems():
-            if name == '_id_' or (len(spec) == 1 and spec[0][0] == '_id'):
-                continue  # ignore the builtin index on "_id"
-            if name not in created:
-                cls._get_collection().drop_index(name)
-                dropped.append(name)
-
-        return (created, dropped)
+    @vultan.instrument.operation('create_indexes')
+    def create_indexes(cls, background=False, dry_run=False):
+        """Creates the declared indexes that are missing and drops those
+        that aren't declared. Returns the (created, dropped) pair of index
+        names, where created names every declared index; see
+        vultan.indexes.reconcile for the plan itself, or to handle several
+        classes at once."""
+        plan, = vultan.indexes.reconcile([cls], background, dry_run)
+        return plan.declared, plan.drop
 
     #####################
     # protected methods #
@@ -195,13 +616,21 @@ class ReadOnlyDocument(object):
 
     @classmethod
     def _get_mongodb(cls):
-        return pymongo.Connection('localhost')['test']
+        return vultan.connection.get_database(cls._connection)
 
     @classmethod
     def _get_collection(cls):
         return cls._get_mongodb()[cls._collection]
 
     @classmethod
+    def _read_options(cls):
+        """Returns the find() keyword arguments that route this class's
+        reads per its _read_preference."""
+        return vultan.routing.read_options(cls._read_preference,
+                                           cls._connection)
+
+    @classmethod
+    @vultan.instrument.phase('decode')
     def _construct(cls, doc, fields):
         return cls(doc, fields)
 
@@ -211,25 +640,64 @@ class ReadOnlyDocument(object):
         return cls._construct(doc=data, fields=None)
 
     @classmethod
+    @vultan.instrument.operation('find_one', vultan.instrument.count_documents)
     def _find_one(cls, query, fields=None):
         spec = cls._query_to_mongo(cls._keys.match(query, unique=True))
         fields = cls._add_key_fields(fields)
-        doc = cls._get_collection().find_one(spec, fields)
+        vultan.instrument.annotate(fields=cls._fields_to_mongo(fields))
+        doc = cls._get_collection().find_one(spec,
+                                             cls._fields_to_mongo(fields),
+                                             **cls._read_options())
         return cls._construct(doc, fields) if doc else None
 
     @classmethod
+    @vultan.instrument.operation('find', vultan.instrument.count_documents)
     def _find(cls, query, fields=None, skip=0, limit=0, sort=None,
               require_index=True):
-        cursor = cls._find_as_cursor(query, fields, skip, limit, require_index)
-        if sort:
-            cursor.sort(sort)
-        return [cls._construct(doc, fields) for doc in cursor]
+        return list(cls._iterfind(query, fields, skip, limit, sort,
+                                  require_index))
+
+    @classmethod
+    def _iterfind(cls, query, fields=None, skip=0, limit=0, sort=None,
+                  require_index=True, batch_size=0):
+        """Like _find, but returns an iterator that constructs each document
+        as it arrives. `batch_size` sets how many documents the server
+        returns per round trip (0 means the server's default)."""
+        cursor = cls._find_as_cursor(query, fields, skip, limit,
+                                     require_index, sort)
+        if batch_size:
+            cursor.batch_size(batch_size)
+        return _DocumentCursor(cursor, lambda doc: cls._construct(doc, fields))
 
     @classmethod
     def _exists(cls, query):
-        return bool(cls._find_as_cursor(query, limit=1).count())
+        """Probes for one matching document, fetching only its _id."""
+        spec = cls._query_to_mongo(cls._keys.match(query))
+        return cls._get_collection().find_one(
+            spec, {'_id': True}, **cls._read_options()) is not None
+
+    @classmethod
+    def _exists_many(cls, name, values):
+        """Returns the subset of `values` for which a document exists whose
+        `name` attribute matches, using a single $in query."""
+        cls._keys.match({name: values}, unique=True)
+        dbname = cls._codec.dbname(name)
+        originals = _encoded_values(cls._codec.encoder(name), values)
+        spec = {dbname: {'$in': originals.keys()}}
+        fields = {dbname: True} if dbname == '_id' else {dbname: True, '_id': False}
+        cursor = cls._get_collection().find(spec, fields,
+                                            **cls._read_options())
+        return _found_values(cursor, dbname, originals)
+
+    @classmethod
+    def _find_many(cls, name, values, fields=None, chunk_size=IN_CHUNK_SIZE):
+        """Looks up documents by many values of the key attribute `name`.
+        Returns a dict mapping each value to its document, or to None if no
+        document has that value. Uses one $in query per `chunk_size` values."""
+        return _find_by_values(cls, name, values, fields, chunk_size)
 
     @classmethod
+    @vultan.instrument.operation('count')
     def _count(cls, query):
         return cls._find_as_cursor(query).count()
 
@@ -238,22 +706,34 @@ class ReadOnlyDocument(object):
     ###################
 
     @classmethod
+    @vultan.instrument.operation('find')
     def _find_as_cursor(cls, query, fields=None, skip=0, limit=0,
-                        require_index=True):
+                        require_index=True, sort=None):
         if require_index:
             cls._keys.match(query)
-        return cls._get_collection().find(spec=cls._query_to_mongo(query),
-                                          fields=cls._add_key_fields(fields),
-                                          skip=skip, limit=limit)
-
-    def _extract(self, name, fieldtype):
+        fields = cls._fields_to_mongo(cls._add_key_fields(fields))
+        vultan.instrument.annotate(sort=sort, fields=fields)
+        cursor = cls._get_collection().find(spec=cls._query_to_mongo(query),
+                                            fields=fields, skip=skip,
+                                            limit=limit,
+                                            **cls._read_options())
+        return cursor.sort(sort) if sort else cursor
+
+    def _extract(self, name, dbname, decode):
         if not self._keys.contains(name):
             if self._expected and name not in self._expected:
                 self._missing.append(name)
                 return
+        if self._lazy:
+            return  # decoded on first access by _LazyField
 
-        value = self._data.get(fieldtype.get_dbname(name))
-        setattr(self, name, fieldtype.from_mongo(value))
+        setattr(self, name, decode(self._data.get(dbname)))
+
+    @classmethod
+    def _fields_to_mongo(cls, fields):
+        if not fields:
+            return None
+        return [cls._codec.dbname(name) for name in fields]
 
     @classmethod
     def _add_key_fields(cls, fields):
@@ -262,61 +742,25 @@ class ReadOnlyDocument(object):
         return list(set(fields).union(cls._keys.names))
 
     @classmethod
+    @vultan.instrument.phase('encode')
     def _document_to_mongo(cls, doc):
-        return cls._to_mongo(doc, 'AUTO')
+        return cls._codec.encode(doc, 'AUTO')
 
     @classmethod
+    @vultan.instrument.phase('encode')
     def _query_to_mongo(cls, doc):
-        def helper(fieldtype, value):
-            if isinstance(value, dict):
-                if all(key.startswith('$') for key in value):
-                    dct = {}
-                    for op, val in value.iteritems():
-                        if op in ['$gt', '$lt', '$gte', '$lte', '$ne']:
-                            dct[op] = fieldtype.to_mongo(val, 'AUTO')
-                        elif op in ['$in', '$nin']:
-                            dct[op] = fieldtype.to_mongo(val, 'MANY')
-                        else:
-                            raise vultan.errors.UnsupportedMongodbOpError(op)
-                    return dct
-            return fieldtype.to_mongo(value, 'NONE')
-
-        answer = {}
-        for key, value in doc.iteritems():
-            fieldtype = cls._get_fieldtype(key)
-            answer[fieldtype.get_dbname(key)] = helper(fieldtype, value)
-        return answer
+        return cls._codec.encode_query(doc)
 
     @classmethod
+    @vultan.instrument.phase('encode')
     def _update_to_mongo(cls, doc):
-        answer = {}
-        for key, value in doc.iteritems():
-            if key.startswith('$'):
-                if key in ['$set', '$unset']:
-                    answer[key] = cls._to_mongo(value, 'AUTO')
-                elif key in ['$push', '$pull']:
-                    answer[key] = cls._to_mongo(value, 'ATOM')
-                elif key in ['$pushAll', '$pullAll']:
-                    answer[key] = cls._to_mongo(value, 'LIST')
-                elif key in ['$inc', '$pop']:
-                    answer[key] = cls._to_mongo(value, dotransform=False)
-                else:
-                    raise vultan.errors.UnsupportedMongodbOpError(key)
-            else:
-                fieldtype = cls._get_fieldtype(key)
-                value = fieldtype.to_mongo(value, 'AUTO')
-                answer[fieldtype.get_dbname(key)] = value
-        return answer
+        return cls._codec.encode_update(doc)
 
     @classmethod
     def _to_mongo(cls, doc, context='AUTO', dotransform=True):
-        answer = {}
-        for key, value in doc.iteritems():
-            fieldtype = cls._get_fieldtype(key)
-            if dotransform:
-                value = fieldtype.to_mongo(value, context)
-            answer[fieldtype.get_dbname(key)] = value
-        return answer
+        if not dotransform:
+            return cls._codec.rename(doc)
+        return cls._codec.encode(doc, context)
 
     @classmethod
     def _get_fieldtype(cls, name):
@@ -335,6 +779,7 @@ class Document(ReadOnlyDocument):
     #####################
 
     @classmethod
+    @vultan.instrument.operation('insert')
     def _insert(cls, doc):
         """Returns the ObjectId of the inserted document."""
         for key in cls._keys:
@@ -344,16 +789,34 @@ class Document(ReadOnlyDocument):
         object_id = cls._get_collection().insert(doc, safe=True)
         return str(object_id)
 
+    @classmethod
     def _insert_multi(cls, docs):
-        """Returns the ObjectIds of the inserted documents."""
-        for key in cls._keys:
-            if key.head != 'id':
-                for doc in docs:
-                    key.match(doc, unique=True)
-        docs = [cls._document_to_mongo(doc) for doc in docs]
-        return [str(object_id) for object_id in cls._get_collection().insert(docs, safe=True)]
+        """Returns the ObjectIds of the inserted documents. Every document
+        is validated and encoded before any is written."""
+        names = cls._keys.unique_names()
+        encoded = []
+        for doc in docs:
+            if not names.issubset(doc):
+                raise vultan.errors.KeyMatchError(doc)
+            encoded.append(cls._document_to_mongo(doc))
+        result = vultan.bulk.insert_many(cls._get_collection(), encoded,
+                                         lambda doc: doc, set())
+        if result.errors:
+            raise result.errors[0][2]
+        return result.ids
+
+    @classmethod
+    def _insert_many(cls, docs, ordered=True,
+                     chunk_size=vultan.bulk.INSERT_CHUNK_SIZE,
+                     chunk_bytes=vultan.bulk.INSERT_CHUNK_BYTES):
+        """Inserts an iterable of documents in bounded chunks. Returns a
+        vultan.bulk.InsertResult."""
+        return vultan.bulk.insert_many(
+            cls._get_collection(), docs, cls._document_to_mongo,
+            cls._keys.unique_names(), ordered, chunk_size, chunk_bytes)
 
     @classmethod
+    @vultan.instrument.operation('update')
     def _update(cls, query, doc, multi=False):
         """Updates exactly one document if multi=False. Otherwise, updates
         zero or more documents."""
@@ -365,6 +828,7 @@ class Document(ReadOnlyDocument):
         return result['n']
 
     @classmethod
+    @vultan.instrument.operation('upsert')
     def _upsert(cls, query, doc):
         """Updates one document or inserts it if it doesn't exist.
            Returns True if it updated an existing document. Otherwise,
@@ -376,6 +840,7 @@ class Document(ReadOnlyDocument):
 
 
     @classmethod
+    @vultan.instrument.operation('remove')
     def _remove(cls, query):
         """Removes matching documents."""
         spec = cls._query_to_mongo(cls._keys.match(query))
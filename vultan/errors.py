@@ -11,8 +11,13 @@ class CreateIndexError(Exception):
 
 class DocumentNotFoundError(Exception): pass
 class InvalidTransformContextError(Exception): pass
+class InvalidPageTokenError(Exception): pass
+class InvalidReadPreferenceError(Exception): pass
 class KeyMatchError(Exception): pass
 class MissingAttributeError(Exception): pass
 class ScalarUsedInVectorTransformContextError(Exception): pass
+class UndeclaredReferenceError(Exception): pass
+class UnknownBackendError(Exception): pass
 class UnrecognizedAttributeError(Exception): pass
+class UnregisteredConnectionError(Exception): pass
 class UnsupportedMongodbOpError(Exception): pass
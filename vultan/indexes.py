@@ -0,0 +1,153 @@
+"""Reconciles collections' indexes with the Keys and Indexes declared on
+document classes and storages.
+
+Existing indexes are read first and compared by field spec and uniqueness,
+so an up-to-date collection costs one index_information() call and no
+writes. New indexes are built before obsolete ones are dropped, so queries
+keep an index to use throughout; the exception is an obsolete index that
+shares a new one's name or key pattern (e.g. its uniqueness changed), which
+mongodb requires to be dropped first.
+
+    plans = vultan.indexes.reconcile([User, Post, PostStorage(Post)],
+                                     dry_run=True)
+    for plan in plans:
+        print plan
+"""
+import vultan.errors
+
+_ID_INDEX = '_id_'
+
+
+class IndexPlan(object):
+    """The changes that make one collection's indexes match its targets'
+    declarations. `create` holds (name, [(dbname, direction)], unique)
+    triples; `drop` and `unchanged` hold index names."""
+    def __init__(self, collection):
+        self.collection = collection
+        self.create = []
+        self.drop = []
+        self.unchanged = []
+        self.applied = False
+        self._drop_keys = {}
+
+    @property
+    def changed(self):
+        return bool(self.create or self.drop)
+
+    @property
+    def declared(self):
+        """The names of every declared index, new or unchanged."""
+        return [name for name, _, _ in self.create] + self.unchanged
+
+    def __str__(self):
+        lines = ['%s%s' % (self.collection.full_name,
+                           '' if self.applied else ' (not applied)')]
+        for name, key, unique in self.create:
+            lines.append('  create %s %s%s' % (name, key,
+                                               ' unique' if unique else ''))
+        lines.extend('  drop %s' % name for name in self.drop)
+        lines.extend('  keep %s' % name for name in self.unchanged)
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '%s(%s, create=%s, drop=%s, unchanged=%s)' % (
+            self.__class__.__name__, self.collection.full_name,
+            [name for name, _, _ in self.create], self.drop, self.unchanged)
+
+
+def reconcile(targets, background=False, dry_run=False):
+    """Plans, and unless `dry_run` applies, the index changes for every
+    document class or storage in `targets`, returning a list of IndexPlans.
+
+    Targets that share a collection have their declarations merged, so one
+    target's indexes are never dropped as obsolete by another's pass. All
+    plans are made before any is applied. With `background`, indexes are
+    built without blocking the collection's other operations.
+    """
+    collections = {}
+    declared = {}
+    for target in targets:
+        target = getattr(target, 'DB', target)  # a NewDocument's storage
+        collection = target._get_collection()
+        specs = declared.setdefault(collection.full_name, {})
+        collections.setdefault(collection.full_name, collection)
+        for key, unique in declared_specs(target):
+            specs[key] = specs.get(key, False) or unique
+
+    plans = [plan_indexes(collections[name], declared[name])
+             for name in sorted(collections)]
+    if not dry_run:
+        for plan in plans:
+            apply_plan(plan, background)
+    return plans
+
+
+def declared_specs(target):
+    """Returns a list of ((dbname, direction) tuple, unique) pairs for the
+    keys declared on a document class or storage, excluding "id"."""
+    return [(tuple((target._codec.dbname(name), direction)
+                   for name, direction in key.index), key.unique)
+            for key in target._keys if key.names != ['id']]
+
+
+def plan_indexes(collection, specs):
+    """Diffs a collection's existing indexes against `specs`, a dict of
+    (dbname, direction) tuples to uniqueness."""
+    answer = IndexPlan(collection)
+    remaining = dict(specs)
+    for name, info in sorted(collection.index_information().iteritems()):
+        if name == _ID_INDEX:
+            continue
+        key = tuple((dbname, _direction(direction))
+                    for dbname, direction in info['key'])
+        if remaining.get(key) == bool(info.get('unique')):
+            del remaining[key]
+            answer.unchanged.append(name)
+        else:
+            answer.drop.append(name)
+            answer._drop_keys[name] = list(key)
+    for key, unique in sorted(remaining.iteritems()):
+        answer.create.append((index_name(key), list(key), unique))
+    return answer
+
+
+def apply_plan(plan, background=False):
+    """Carries out `plan`. Returns it, marked as applied."""
+    collection = plan.collection
+    names = set(name for name, _, _ in plan.create)
+    keys = [key for _, key, _ in plan.create]
+    conflicting = [name for name in plan.drop
+                   if name in names or plan._drop_keys[name] in keys]
+    for name in conflicting:
+        collection.drop_index(name)
+    for name, key, unique in plan.create:
+        _create(collection, name, key, unique, background)
+    for name in plan.drop:
+        if name not in conflicting:
+            collection.drop_index(name)
+
+    created = [name for name, _, _ in plan.create]
+    missing = list(set(created) - set(collection.index_information()))
+    if missing:
+        raise vultan.errors.CreateIndexError(collection, missing)
+    plan.applied = True
+    return plan
+
+
+def index_name(key):
+    """Returns the name mongodb gives an index on `key` by default."""
+    return '_'.join('%s_%s' % (dbname, direction) for dbname, direction in key)
+
+
+def _create(collection, name, key, unique, background):
+    options = dict(name=name, unique=unique)
+    if background:
+        options['background'] = True
+    collection.create_index(key, **options)
+
+
+def _direction(direction):
+    # Specs written by some clients store directions as floats.
+    if isinstance(direction, float):
+        return int(direction)
+    return direction
@@ -0,0 +1,195 @@
+"""Timing and counting hooks around storage operations.
+
+Instrumentation is off until a listener or a slow-operation threshold is
+set; until then, instrumented methods cost one extra function call.
+
+    vultan.instrument.add_listener(lambda record: statsd.timing(
+        'mongo.%s.%s' % (record.collection, record.operation),
+        record.wall_time))
+    vultan.instrument.set_slow_threshold(0.1)
+"""
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger('vultan.slow')
+# Failures of listeners and of the slow log, which never reach the caller.
+error_logger = logging.getLogger('vultan.instrument')
+
+_listeners = []
+_slow_threshold = None
+_explain_slow = True
+_local = threading.local()
+
+# Operations whose spec can be explained with a find().
+_READS = set(['find', 'find_one', 'count'])
+
+
+class OperationRecord(object):
+    """What one storage operation did and where its time went.
+
+    `server_time` is the wall time not spent encoding the request or
+    decoding the results, i.e. time in the driver and on the server.
+    `collection` is the bare collection name, `namespace` the full
+    "db.collection" one.
+    """
+    def __init__(self, operation, collection, storage=None):
+        self.operation = operation
+        self.collection = collection
+        self._storage = storage
+        self.spec = None
+        self.sort = None
+        self.fields = None
+        self.documents = None
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.wall_time = 0.0
+        self.error = None
+
+    @property
+    def server_time(self):
+        return max(0.0, self.wall_time - self.encode_time - self.decode_time)
+
+    @property
+    def namespace(self):
+        if self._storage is None:
+            return self.collection
+        return self._storage._get_collection().full_name
+
+    @property
+    def shape(self):
+        """The encoded spec with every value replaced by 1."""
+        return spec_shape(self.spec) if self.spec is not None else None
+
+    def __repr__(self):
+        return '%s(%s.%s %s, %.6fs)' % (self.__class__.__name__,
+                                        self.collection, self.operation,
+                                        self.shape, self.wall_time)
+
+
+def spec_shape(spec):
+    if isinstance(spec, dict):
+        return dict((key, spec_shape(value)) for key, value in spec.iteritems())
+    if isinstance(spec, list) and spec and isinstance(spec[0], dict):
+        return [spec_shape(item) for item in spec]
+    return 1
+
+
+def add_listener(callback):
+    """Calls `callback` with an OperationRecord after every operation."""
+    _listeners.append(callback)
+
+
+def remove_listener(callback):
+    _listeners.remove(callback)
+
+
+def set_slow_threshold(seconds, explain=True):
+    """Logs operations slower than `seconds` to the "vultan.slow" logger,
+    with the server's explain() output for reads if `explain` is set.
+    None disables the log."""
+    global _slow_threshold, _explain_slow
+    _slow_threshold = seconds
+    _explain_slow = explain
+
+
+def operation(name, count=None):
+    """Decorates a storage method (or classmethod function) so that each
+    call produces an OperationRecord. `count` maps the method's result to
+    the number of documents it returned."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if getattr(_local, 'record', None) is not None or \
+                    (not _listeners and _slow_threshold is None):
+                return method(self, *args, **kwargs)
+            record = OperationRecord(name, getattr(self, '_collection', None),
+                                     self)
+            _local.record = record
+            start = time.time()
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception, exception:
+                record.error = exception
+                raise
+            else:
+                if count is not None:
+                    record.documents = count(result)
+                return result
+            finally:
+                record.wall_time = time.time() - start
+                _local.record = None
+                _report(self, record)
+        return wrapper
+    return decorator
+
+
+def phase(kind):
+    """Decorates an encoding or decoding method so that its time is
+    charged to the current operation's `kind`_time ('encode' or 'decode').
+    Encoders also record the first spec they produce."""
+    attribute = kind + '_time'
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            record = getattr(_local, 'record', None)
+            if record is None:
+                return method(self, *args, **kwargs)
+            start = time.time()
+            result = method(self, *args, **kwargs)
+            setattr(record, attribute,
+                    getattr(record, attribute) + time.time() - start)
+            if kind == 'encode' and record.spec is None:
+                record.spec = result
+            return result
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes):
+    """Sets attributes (e.g. sort, fields) on the current operation's
+    record, if one is being made."""
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        for name, value in attributes.iteritems():
+            setattr(record, name, value)
+
+
+def count_documents(result):
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def _report(storage, record):
+    for callback in list(_listeners):
+        try:
+            callback(record)
+        except Exception:
+            error_logger.exception('listener %r failed on %r', callback,
+                                   record)
+    if _slow_threshold is not None and record.wall_time >= _slow_threshold:
+        try:
+            _log_slow(storage, record)
+        except Exception:
+            error_logger.exception('slow log failed on %r', record)
+
+
+def _log_slow(storage, record):
+    plan = None
+    if _explain_slow and record.operation in _READS and \
+            record.spec is not None:
+        try:
+            plan = storage._get_collection().find(record.spec).explain()
+        except Exception, exception:
+            error_logger.exception('explain failed on %r', record)
+            plan = 'explain failed: %r' % exception
+    logger.warning('slow %s on %s took %.3fs (encode %.3fs, server '
+                   '%.3fs, decode %.3fs), spec %s, plan %s',
+                   record.operation, record.collection, record.wall_time,
+                   record.encode_time, record.server_time,
+                   record.decode_time, record.shape, plan)
@@ -0,0 +1,691 @@
+"""An in-process stand-in for the parts of pymongo that vultan uses.
+
+MemoryConnection, MemoryDatabase, MemoryCollection and MemoryCursor mimic
+pymongo's Connection, Database, Collection and Cursor closely enough to run
+vultan documents and storages without a server. Register an alias with
+backend='memory' to use them:
+
+    vultan.connection.register('reference', db='ref', backend='memory')
+
+Documents live in a dict keyed by _id. Indexes made with create_index (e.g.
+by create_indexes() from the declared Keys and Indexes) are real: they
+enforce uniqueness, and queries with equality or $in conditions on an
+index's leading fields only examine the documents the index points to.
+Everything else is a scan. Values are deep-copied on the way in and out, as
+if they had been through BSON.
+"""
+import copy
+import datetime
+import itertools
+import threading
+import pymongo
+import pymongo.errors
+import pymongo.objectid
+
+
+class MemoryConnection(object):
+    def __init__(self, *args, **kwargs):
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def database_names(self):
+        return sorted(self._databases)
+
+    def drop_database(self, name):
+        with self._lock:
+            self._databases.pop(getattr(name, 'name', name), None)
+
+    def disconnect(self):
+        pass
+
+
+class MemoryDatabase(object):
+    def __init__(self, name='test'):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self):
+        return sorted(self._collections)
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._collections.pop(getattr(name, 'name', name), None)
+
+    def command(self, command, *args, **kwargs):
+        name = command if isinstance(command, basestring) else iter(command).next()
+        raise pymongo.errors.OperationFailure('no such cmd: %s' % name)
+
+
+class MemoryCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self._docs = {}
+        self._lock = threading.RLock()
+        self._indexes = {}
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None,
+             **kwargs):
+        cursor = MemoryCursor(self, spec, fields, skip, limit)
+        if sort:
+            cursor.sort(sort)
+        return cursor
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for doc in self.find(spec_or_id, fields, limit=-1, **kwargs):
+            return doc
+        return None
+
+    def count(self):
+        return len(self._docs)
+
+    def insert(self, doc_or_docs, manipulate=True, safe=False,
+               check_keys=True, continue_on_error=False, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        ids = []
+        error = None
+        with self._lock:
+            for doc in docs:
+                if '_id' not in doc:
+                    doc['_id'] = pymongo.objectid.ObjectId()
+                try:
+                    self._store(doc['_id'], copy.deepcopy(doc), None)
+                except pymongo.errors.DuplicateKeyError, exception:
+                    error = error or exception
+                    if not continue_on_error:
+                        break
+                ids.append(doc['_id'])
+        if error:
+            raise error
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def save(self, doc, safe=False, **kwargs):
+        if '_id' not in doc:
+            return self.insert(doc, safe=safe)
+        self.update({'_id': doc['_id']}, doc, upsert=True, safe=safe)
+        return doc['_id']
+
+    def update(self, spec, document, upsert=False, manipulate=False,
+               safe=False, multi=False, **kwargs):
+        with self._lock:
+            n = 0
+            for _id in self._matching_ids(spec):
+                old = self._docs[_id]
+                self._store(_id, _apply_update(old, document), old)
+                n += 1
+                if not multi:
+                    break
+            result = {'n': n, 'updatedExisting': n > 0, 'err': None, 'ok': 1}
+            if not n and upsert:
+                doc = dict((key, copy.deepcopy(value))
+                           for key, value in (spec or {}).iteritems()
+                           if not key.startswith('$') and not _is_operator(value))
+                doc = _apply_update(doc, document)
+                if '_id' not in doc:
+                    doc['_id'] = pymongo.objectid.ObjectId()
+                self._store(doc['_id'], doc, None)
+                result.update(n=1, upserted=doc['_id'])
+        return result if safe else None
+
+    def remove(self, spec_or_id=None, safe=False, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self._lock:
+            ids = list(self._matching_ids(spec_or_id))
+            for _id in ids:
+                self._discard(_id)
+        return {'n': len(ids), 'err': None, 'ok': 1} if safe else None
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def create_index(self, key_or_list, unique=False, **kwargs):
+        key = _index_key(key_or_list)
+        name = kwargs.get('name') or '_'.join('%s_%s' % pair for pair in key)
+        with self._lock:
+            for other_name, other in self._indexes.iteritems():
+                same = (other.key, other.unique) == (key, bool(unique))
+                if (other_name == name) != (other.key == key) or \
+                        (other_name == name and not same):
+                    # Like mongod, one index per name and per key pattern.
+                    raise pymongo.errors.OperationFailure(
+                        'index %s conflicts with existing index %s' %
+                        (name, other_name), 85)
+            if name not in self._indexes:
+                index = _Index(key, bool(unique))
+                for _id, doc in self._docs.iteritems():
+                    if not index.check(_id, doc):
+                        raise _duplicate_key_error(self, name)
+                    index.add(_id, doc)
+                self._indexes[name] = index
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        with self._lock:
+            info = dict((name, index.info())
+                        for name, index in self._indexes.iteritems())
+        info['_id_'] = {'key': [('_id', pymongo.ASCENDING)], 'v': 1}
+        return info
+
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, basestring):
+            name = '_'.join('%s_%s' % pair for pair in _index_key(name))
+        with self._lock:
+            if name not in self._indexes:
+                raise pymongo.errors.OperationFailure('index not found')
+            del self._indexes[name]
+
+    def drop_indexes(self):
+        with self._lock:
+            self._indexes.clear()
+
+    #
+    # private methods
+    #
+
+    def _store(self, _id, doc, old):
+        if old is None and _id in self._docs:
+            raise _duplicate_key_error(self, '_id_')
+        for name, index in self._indexes.iteritems():
+            if not index.check(_id, doc):
+                raise _duplicate_key_error(self, name)
+        for index in self._indexes.itervalues():
+            if old is not None:
+                index.remove(_id, old)
+            index.add(_id, doc)
+        self._docs[_id] = doc
+
+    def _discard(self, _id):
+        doc = self._docs.pop(_id)
+        for index in self._indexes.itervalues():
+            index.remove(_id, doc)
+
+    def _plan(self, spec, hint=None):
+        """Returns (index name, candidate _ids) for the documents that may
+        match `spec`, or (None, all _ids) if no index applies. A `hint`
+        (an index name or key) forces the choice of index."""
+        spec = spec or {}
+        if hint is not None:
+            name = hint if isinstance(hint, basestring) else \
+                '_'.join('%s_%s' % pair for pair in _index_key(hint))
+            if name not in self._indexes:
+                raise pymongo.errors.OperationFailure('bad hint')
+            values = self._prefix_values(self._indexes[name], spec)
+            if not values:
+                return name, list(self._docs)
+            return name, self._indexes[name].lookup(values)
+        if '_id' in spec:
+            values = _lookup_values(spec['_id'])
+            if values is not None:
+                try:
+                    return '_id_', [value for value in values
+                                    if value in self._docs]
+                except TypeError:
+                    pass  # an unhashable _id; scan instead
+        best_name, best_index, best_values = None, None, []
+        for name, index in self._indexes.iteritems():
+            values = self._prefix_values(index, spec)
+            if len(values) > len(best_values):
+                best_name, best_index, best_values = name, index, values
+        if best_index is None:
+            return None, list(self._docs)
+        return best_name, best_index.lookup(best_values)
+
+    def _prefix_values(self, index, spec):
+        """Returns the values `spec` allows for each of the leading fields
+        of `index` it restricts to a set of values."""
+        values = []
+        for field, _ in index.key:
+            field_values = _lookup_values(spec.get(field, _MISSING))
+            if field_values is None:
+                break
+            values.append(field_values)
+        return values
+
+    def _candidates(self, spec, hint=None):
+        """Returns the _ids of documents that may match `spec`."""
+        return self._plan(spec, hint)[1]
+
+    def _matching_ids(self, spec, hint=None):
+        return [_id for _id in self._candidates(spec, hint)
+                if _matches(self._docs[_id], spec or {})]
+
+
+class MemoryCursor(object):
+    def __init__(self, collection, spec, fields, skip, limit):
+        self.collection = collection
+        self._spec = spec or {}
+        self._fields = fields
+        self._skip = skip
+        self._limit = limit
+        self._sort = None
+        self._hint = None
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        if direction is not None:
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        self._hint = index
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        with self.collection._lock:
+            n = len(self.collection._matching_ids(self._spec, self._hint))
+        if with_limit_and_skip:
+            n = max(0, n - (self._skip or 0))
+            if self._limit:
+                n = min(n, abs(self._limit))
+        return n
+
+    def explain(self):
+        collection = self.collection
+        with collection._lock:
+            name, candidates = collection._plan(self._spec, self._hint)
+            index = collection._indexes.get(name)
+        cursor = 'BtreeCursor %s' % name if name else 'BasicCursor'
+        index_only = index is not None and _is_covered(index, self._spec,
+                                                       self._fields)
+        return {'cursor': cursor, 'n': self.count(True),
+                'nscanned': len(candidates),
+                'nscannedObjects': 0 if index_only else len(candidates),
+                'indexOnly': index_only}
+
+    def close(self):
+        self._results = iter(())
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._results is None:
+            self._results = iter(self._execute())
+        return self._results.next()
+
+    def _execute(self):
+        collection = self.collection
+        with collection._lock:
+            docs = [collection._docs[_id] for _id
+                    in collection._matching_ids(self._spec, self._hint)]
+            for key, direction in reversed(self._sort or []):
+                docs.sort(key=lambda doc: _sort_key(_get_path(doc, key)),
+                          reverse=direction == pymongo.DESCENDING)
+            docs = docs[self._skip or 0:]
+            if self._limit:
+                docs = docs[:abs(self._limit)]
+            return [_project(doc, self._fields) for doc in docs]
+
+
+#
+# query matching
+#
+
+_MISSING = object()
+
+_TYPE_ORDER = [
+    (type(None), 1), (bool, 8), (int, 2), (long, 2), (float, 2),
+    (basestring, 3), (dict, 4), (list, 5),
+    (pymongo.objectid.ObjectId, 7), (datetime.datetime, 9),
+]
+
+
+def _type_rank(value):
+    for cls, rank in _TYPE_ORDER:
+        if isinstance(value, cls):
+            return rank
+    return 6
+
+
+def _sort_key(value):
+    if value is _MISSING:
+        value = None
+    return (_type_rank(value), value)
+
+
+def _is_operator(value):
+    return isinstance(value, dict) and value and \
+        all(key.startswith('$') for key in value)
+
+
+def _get_path(doc, path):
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit() and \
+                int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _matches(doc, spec):
+    for key, condition in spec.iteritems():
+        if key == '$or':
+            if not any(_matches(doc, clause) for clause in condition):
+                return False
+        elif key == '$and':
+            if not all(_matches(doc, clause) for clause in condition):
+                return False
+        elif key == '$nor':
+            if any(_matches(doc, clause) for clause in condition):
+                return False
+        elif not _matches_value(_get_path(doc, key), condition):
+            return False
+    return True
+
+
+def _candidates(value):
+    """The values a condition is tested against: arrays match if any of
+    their items (or the array itself) does."""
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+
+def _equals(value, target):
+    if value is _MISSING:
+        return target is None
+    return any(item == target and _type_rank(item) == _type_rank(target)
+               for item in _candidates(value))
+
+
+def _compare(value, target, test):
+    if value is _MISSING:
+        return False
+    return any(_type_rank(item) == _type_rank(target) and test(item, target)
+               for item in _candidates(value))
+
+
+_OPERATORS = {
+    '$gt': lambda value, arg: _compare(value, arg, lambda a, b: a > b),
+    '$gte': lambda value, arg: _compare(value, arg, lambda a, b: a >= b),
+    '$lt': lambda value, arg: _compare(value, arg, lambda a, b: a < b),
+    '$lte': lambda value, arg: _compare(value, arg, lambda a, b: a <= b),
+    '$ne': lambda value, arg: not _equals(value, arg),
+    '$in': lambda value, arg: any(_equals(value, item) for item in arg),
+    '$nin': lambda value, arg: not any(_equals(value, item) for item in arg),
+    '$exists': lambda value, arg: (value is not _MISSING) == bool(arg),
+    '$all': lambda value, arg: all(_equals(value, item) for item in arg),
+    '$size': lambda value, arg: isinstance(value, list) and len(value) == arg,
+    '$not': lambda value, arg: not _matches_value(value, arg),
+}
+
+
+def _matches_value(value, condition):
+    if _is_operator(condition):
+        for op, arg in condition.iteritems():
+            try:
+                test = _OPERATORS[op]
+            except KeyError:
+                raise pymongo.errors.OperationFailure(
+                    'invalid operator: %s' % op)
+            if not test(value, arg):
+                return False
+        return True
+    return _equals(value, condition)
+
+
+def _project(doc, fields):
+    if fields is None:
+        return copy.deepcopy(doc)
+    if not isinstance(fields, dict):
+        fields = dict((name, True) for name in fields)
+    include_id = fields.get('_id', True)
+    included = [name for name, flag in fields.iteritems()
+                if flag and name != '_id']
+    if included:
+        answer = {}
+        for name in included:
+            value = _get_path(doc, name)
+            if value is not _MISSING:
+                _set_path(answer, name, copy.deepcopy(value))
+    else:
+        excluded = set(name for name, flag in fields.iteritems() if not flag)
+        answer = dict((key, copy.deepcopy(value))
+                      for key, value in doc.iteritems() if key not in excluded)
+    if include_id and '_id' in doc:
+        answer['_id'] = doc['_id']
+    else:
+        answer.pop('_id', None)
+    return answer
+
+
+#
+# updates
+#
+
+def _set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _get_list(doc, path):
+    value = _get_path(doc, path)
+    if value is _MISSING:
+        value = []
+        _set_path(doc, path, value)
+    if not isinstance(value, list):
+        raise pymongo.errors.OperationFailure(
+            'Cannot apply array modifier to non-array: %s' % path)
+    return value
+
+
+def _pull(items, condition):
+    if _is_operator(condition):
+        return [item for item in items if not _matches_value(item, condition)]
+    return [item for item in items if item != condition]
+
+
+def _apply_update(doc, document):
+    """Returns a copy of `doc` with the update `document` applied."""
+    if not any(key.startswith('$') for key in document):
+        answer = copy.deepcopy(document)
+        if '_id' in doc:
+            answer['_id'] = doc['_id']
+        return answer
+
+    answer = copy.deepcopy(doc)
+    for op, changes in document.iteritems():
+        for path, arg in changes.iteritems():
+            arg = copy.deepcopy(arg)
+            if op == '$set':
+                _set_path(answer, path, arg)
+            elif op == '$unset':
+                _unset_path(answer, path)
+            elif op == '$inc':
+                current = _get_path(answer, path)
+                _set_path(answer, path,
+                          (0 if current is _MISSING else current) + arg)
+            elif op == '$push':
+                _get_list(answer, path).append(arg)
+            elif op == '$pushAll':
+                _get_list(answer, path).extend(arg)
+            elif op == '$addToSet':
+                items = _get_list(answer, path)
+                for item in (arg.get('$each', []) if _is_operator(arg) else [arg]):
+                    if item not in items:
+                        items.append(item)
+            elif op == '$pull':
+                _set_path(answer, path, _pull(_get_list(answer, path), arg))
+            elif op == '$pullAll':
+                _set_path(answer, path, [item for item in _get_list(answer, path)
+                                         if item not in arg])
+            elif op == '$pop':
+                items = _get_list(answer, path)
+                if items:
+                    items.pop(0 if arg < 0 else -1)
+            else:
+                raise pymongo.errors.OperationFailure(
+                    'Invalid modifier specified: %s' % op)
+    return answer
+
+
+#
+# indexes
+#
+
+class _Index(object):
+    """A secondary index: maps each prefix of the index's key, as a tuple
+    of values, to the _ids of the documents having that prefix. Array
+    values are indexed by their items, like a multikey index."""
+    def __init__(self, key, unique):
+        self.key = key
+        self.unique = unique
+        self._entries = [{} for _ in key]
+
+    def info(self):
+        info = {'key': list(self.key), 'v': 1}
+        if self.unique:
+            info['unique'] = True
+        return info
+
+    def check(self, _id, doc):
+        """Returns False if adding `doc` would violate uniqueness."""
+        if not self.unique:
+            return True
+        entries = self._entries[-1]
+        return all(entries.get(values, set()) <= set([_id])
+                   for values in self._values(doc))
+
+    def add(self, _id, doc):
+        for values in self._values(doc):
+            for i, entries in enumerate(self._entries):
+                entries.setdefault(values[:i + 1], set()).add(_id)
+
+    def remove(self, _id, doc):
+        for values in self._values(doc):
+            for i, entries in enumerate(self._entries):
+                ids = entries.get(values[:i + 1])
+                if ids is not None:
+                    ids.discard(_id)
+                    if not ids:
+                        del entries[values[:i + 1]]
+
+    def lookup(self, values):
+        """Returns the _ids under every combination of `values`, a list of
+        acceptable values for each of the index's leading fields."""
+        entries = self._entries[len(values) - 1]
+        answer = set()
+        hashed = [[_hashable(value) for value in field] for field in values]
+        for prefix in itertools.product(*hashed):
+            answer.update(entries.get(prefix, ()))
+        return list(answer)
+
+    def _values(self, doc):
+        fields = []
+        for field, _ in self.key:
+            value = _get_path(doc, field)
+            if value is _MISSING:
+                value = None
+            items = value if isinstance(value, list) and value else [value]
+            fields.append(set(_hashable(item) for item in items))
+        return itertools.product(*fields)
+
+
+def _is_covered(index, spec, fields):
+    """True if a query can be answered from `index` alone: it projects out
+    _id and tests and returns only fields of the index."""
+    if not fields:
+        return False
+    if not isinstance(fields, dict):
+        fields = dict((name, True) for name in fields)
+    names = [name for name in fields if name != '_id']
+    if fields.get('_id', True) or not all(fields[name] for name in names):
+        return False
+    indexed = set(field for field, _ in index.key)
+    return indexed.issuperset(names) and \
+        indexed.issuperset(name for name in spec if not name.startswith('$'))
+
+
+def _hashable(value):
+    """Returns a hashable stand-in for `value` that distinguishes values
+    of different BSON types but equates numbers."""
+    if isinstance(value, list):
+        return (5, tuple(_hashable(item) for item in value))
+    if isinstance(value, dict):
+        return (4, tuple(sorted((key, _hashable(item))
+                                for key, item in value.iteritems())))
+    return (_type_rank(value), value)
+
+
+def _lookup_values(condition):
+    """Returns the values an index lookup for `condition` must cover, or
+    None if an index can't answer it."""
+    if condition is _MISSING or isinstance(condition, list):
+        return None
+    if _is_operator(condition):
+        if condition.keys() != ['$in'] or \
+                any(isinstance(item, list) for item in condition['$in']):
+            return None
+        return condition['$in']
+    return [condition]
+
+
+def _duplicate_key_error(collection, name):
+    return pymongo.errors.DuplicateKeyError(
+        'E11000 duplicate key error index: %s.$%s' % (collection.full_name,
+                                                       name))
+
+
+def _index_key(key_or_list):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, pymongo.ASCENDING)]
+    return [tuple(pair) for pair in key_or_list]
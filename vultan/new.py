@@ -1,50 +1,145 @@
+import base64
+import bson
+import collections
+import functools
+import itertools
+import multiprocessing
 import pymongo
+import pymongo.objectid
 import pymongo.errors
+import vultan.bulk
+import vultan.cache
+import vultan.connection
 import vultan.errors
+import vultan.indexes
+import vultan.instrument
+import vultan.routing
 import vultan.types
-from vultan.document import _KeySet, _Attributes
+from vultan.document import Key, _KeySet, _Attributes, _Codec, _DocumentCursor, \
+    IN_CHUNK_SIZE, _encoded_values, _find_by_values, _found_values, \
+    _install_lazy_fields, _add_slots, _get_missing, _peek
 
+# parallel_scan workers send documents back in chunks of at most this many.
+SCAN_CHUNK_SIZE = 1000
 
 class Storage(object):
+    _connection = None
+
+    # Set _cache_size to cache find_one results by unique key values.
+    # The cache holds raw BSON, and every hit constructs a new document, so
+    # callers may change (and save()) what they get.
+    _cache_size = 0
+    _cache_ttl = None
+
+    # A vultan.routing.ReadPreference (or mode name) for reads; None means
+    # the document class's, and by default every read goes to the primary.
+    _read_preference = None
+
     def __init__(self, document_class):
         self._document_class = document_class
         self._keys = document_class._keys
         self._attributes = document_class._attributes
-
-    def create_indexes(self):
-        '''Ensures that only required indexes exist.'''
-        created = []
-        for key in (key for key in self._keys if key.names != ['id']):
-            key_or_list = [(self._attributes.get_dbname(name), direction)
-                           for name, direction in key.index]
-            created.append(self._get_collection().create_index(
-                key_or_list, unique=key.unique))
-
-        indexes = self._get_collection().index_information()
-        missing = list(set(created) - set(indexes.keys()))
-        if missing:
-            raise vultan.errors.CreateIndexError(self._get_collection(), missing)
-
-        dropped = []
-        for name, spec in indexes.iteritems():
-            if name == '_id_' or (len(spec) == 1 and spec[0][0] == '_id'):
-                continue  # ignore the builtin index on "_id"
-            if name not in created:
-                self._get_collection().drop_index(name)
-                dropped.append(name)
-
-        return (created, dropped)
+        self._codec = document_class._codec
+        self._cache = None
+        if self._cache_size:
+            self._cache = vultan.cache.DocumentCache(self._cache_size,
+                                                     self._cache_ttl)
+            self._key_dbnames = set(self._codec.dbname(name)
+                                    for name in self._keys.names)
+
+    @vultan.instrument.operation('create_indexes')
+    def create_indexes(self, background=False, dry_run=False):
+        '''Creates the declared indexes that are missing and drops those
+        that aren't declared. Returns the (created, dropped) pair of index
+        names, where created names every declared index; see
+        vultan.indexes.reconcile for the plan itself.'''
+        plan, = vultan.indexes.reconcile([self], background, dry_run)
+        return plan.declared, plan.drop
+
+    def parallel_scan(self, query, workers=None, fields=None, mapper=None,
+                      reducer=None, splits_per_worker=4,
+                      chunk_size=SCAN_CHUNK_SIZE):
+        '''Scans every document matching `query` with a pool of `workers`
+        processes (default: one per CPU), yielding documents in no
+        particular order.
+
+        The _id space is cut into ranges by interpolating between the
+        oldest and newest ObjectId; each range is scanned in _id order,
+        decoded and passed through `mapper` in a worker with its own
+        connection, `chunk_size` documents per task, so neither side holds
+        more than a chunk per range at a time. If `reducer` is given, each
+        worker reduces its mapped values for a whole range and the partial
+        results are yielded instead. `mapper`, `reducer` and this storage's
+        class must be picklable (i.e. defined at module level).
+        '''
+        workers = workers or multiprocessing.cpu_count()
+        spec = self._query_to_mongo(query)
+        ranges = self._split_by_id(spec, workers * splits_per_worker)
+        tasks = [(type(self), self._document_class, range_spec, None, fields,
+                  mapper, reducer, chunk_size) for range_spec in ranges]
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            running = collections.deque(pool.apply_async(_scan_range, (task,))
+                                        for task in tasks)
+            while running:
+                values, task = running.popleft().get()
+                if task is not None:
+                    running.append(pool.apply_async(_scan_range, (task,)))
+                for value in values:
+                    yield value
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def parallel_reduce(self, query, mapper, reducer, initial=None, **kwargs):
+        '''Maps and reduces every matching document across a process pool;
+        see parallel_scan. Returns `initial` if nothing matches.'''
+        partials = self.parallel_scan(query, mapper=mapper, reducer=reducer,
+                                      **kwargs)
+        if initial is None:
+            return _reduce_or_none(reducer, partials)
+        return reduce(reducer, partials, initial)
+
+    def find_columns(self, query, fields, require_index=True):
+        '''Returns the `fields` attributes of every matching document as a
+        dict of numpy masked arrays, one per attribute, with missing values
+        masked. Int, float, bool and datetime attributes get native numpy
+        dtypes; others are object arrays. Decodes straight from the raw
+        results without constructing documents. Requires numpy.'''
+        import vultan.columns
+        if require_index:
+            self._keys.match(query)
+        cursor = self._get_collection().find(spec=self._query_to_mongo(query),
+                                             fields=self._codec.projection(fields),
+                                             **self._read_options())
+        return vultan.columns.build_columns(cursor, self._codec,
+                                            self._attributes, fields)
+
+    def cache_stats(self):
+        '''Returns the cache's counters, or None if caching is disabled.'''
+        return self._cache.stats() if self._cache is not None else None
 
     #
     # protected methods
     #
 
     def _get_mongodb(self):
-        return pymongo.Connection('localhost')['test']
+        return vultan.connection.get_database(self._get_alias())
+
+    def _get_alias(self):
+        return self._connection or self._document_class._connection
+
+    def _read_options(self):
+        '''Returns the find() keyword arguments that route this storage's
+        reads per its (or its document class's) _read_preference.'''
+        preference = self._read_preference or \
+            self._document_class._read_preference
+        return vultan.routing.read_options(preference, self._get_alias())
 
     def _get_collection(self):
         return self._get_mongodb()[self._collection]
 
+    @vultan.instrument.phase('decode')
     def _construct(self, doc, fields):
         return self._document_class(doc, fields)
 
@@ -52,124 +147,367 @@ class Storage(object):
         data = self._document_to_mongo(kwargs)
         return self._construct(doc=data, fields=None)
 
+    @vultan.instrument.operation('find_one', vultan.instrument.count_documents)
     def _find_one(self, query, fields=None):
         spec = self._query_to_mongo(self._keys.match(query, unique=True))
         fields = self._add_key_fields(fields)
-        doc = self._get_collection().find_one(spec, fields)
-        return self._construct(doc, fields) if doc else None
-
+        vultan.instrument.annotate(fields=self._fields_to_mongo(fields))
+        cache_key = self._get_cache_key(spec, fields)
+        if cache_key is not None:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                return self._construct(bson.BSON(cached).decode(), fields)
+            snapshot = self._cache.snapshot()
+        doc = self._get_collection().find_one(spec,
+                                              self._fields_to_mongo(fields),
+                                              **self._read_options())
+        if not doc:
+            return None
+        if cache_key is not None:
+            self._cache.put(cache_key, bson.BSON.encode(doc),
+                            self._get_cache_pairs(doc), snapshot)
+        return self._construct(doc, fields)
+
+    @vultan.instrument.operation('find', vultan.instrument.count_documents)
     def _find(self, query, fields=None, skip=0, limit=0, sort=None, require_index=True):
-        cursor = self._find_as_cursor(query, fields, skip, limit, require_index)
-        if sort:
-            cursor.sort(sort)
-        return [self._construct(doc, fields) for doc in cursor]
+        return list(self._iterfind(query, fields, skip, limit, sort, require_index))
+
+    def _iterfind(self, query, fields=None, skip=0, limit=0, sort=None,
+                  require_index=True, batch_size=0):
+        '''Like _find, but returns an iterator that constructs each document
+        as it arrives. `batch_size` sets how many documents the server
+        returns per round trip (0 means the server's default).'''
+        cursor = self._find_as_cursor(query, fields, skip, limit,
+                                      require_index, sort)
+        if batch_size:
+            cursor.batch_size(batch_size)
+        return _DocumentCursor(cursor, lambda doc: self._construct(doc, fields))
+
+    def _values_list(self, query, names, skip=0, limit=0, sort=None,
+                     require_index=True, batch_size=0):
+        '''Returns an iterator of tuples holding the `names` attributes of
+        each matching document. Only those fields are fetched and decoded;
+        no documents are constructed.'''
+        return self._find_rows(query, names, self._row_maker(names), skip,
+                               limit, sort, require_index, batch_size)
+
+    def _find_covered(self, query, names, skip=0, limit=0, sort=None,
+                      require_index=True, batch_size=0):
+        '''Like _values_list, but hints a declared index holding `names` and
+        every queried and sorted-on field (`sort` is in attribute names), so
+        the server answers from the index without reading any documents.
+        If no index covers the query, it runs unhinted.'''
+        index = self._covering_index(query, names, sort)
+        sort = [(self._codec.dbname(name), direction)
+                for name, direction in sort or ()]
+        hint = None
+        if index is not None:
+            hint = [(self._codec.dbname(name), direction)
+                    for name, direction in index.index]
+        return self._find_rows(query, names, self._row_maker(names), skip,
+                               limit, sort, require_index, batch_size, hint)
+
+    def _covering_index(self, query, names, sort=None):
+        '''Returns a declared key or index that holds every field in `names`,
+        `query` and `sort` and that the query can use, or None. Indexes on
+        list fields never cover, as they hold the lists' items.'''
+        needed = set(names).union(query, (name for name, _ in sort or ()))
+        for key in self._keys:
+            if not needed.issubset(key.names) or \
+                    any(self._is_multikey(name) for name in key.names):
+                continue
+            if key.head in query or (not query and sort and
+                                     sort[0][0] == key.head):
+                return key
+        return None
+
+    def _values(self, query, name, skip=0, limit=0, sort=None,
+                require_index=True, batch_size=0):
+        '''Like _values_list for a single attribute, returning an iterator of
+        its bare values.'''
+        dbname = self._codec.dbname(name)
+        decode = self._codec.decoder(name)
+        return self._find_rows(query, [name], lambda doc: decode(doc.get(dbname)),
+                               skip, limit, sort, require_index, batch_size)
 
     def _exists(self, query):
-        return bool(self._find_as_cursor(query, limit=1).count())
-
+        '''Probes for one matching document, fetching only its _id.'''
+        spec = self._query_to_mongo(self._keys.match(query))
+        return self._get_collection().find_one(
+            spec, {'_id': True}, **self._read_options()) is not None
+
+    def _exists_many(self, name, values):
+        '''Returns the subset of `values` for which a document exists whose
+        `name` attribute matches, using a single $in query.'''
+        self._keys.match({name: values}, unique=True)
+        dbname = self._codec.dbname(name)
+        originals = _encoded_values(self._codec.encoder(name), values)
+        spec = {dbname: {'$in': originals.keys()}}
+        fields = {dbname: True} if dbname == '_id' else {dbname: True, '_id': False}
+        cursor = self._get_collection().find(spec, fields,
+                                             **self._read_options())
+        return _found_values(cursor, dbname, originals)
+
+    def _find_many(self, name, values, fields=None, chunk_size=IN_CHUNK_SIZE):
+        '''Looks up documents by many values of the key attribute `name`.
+        Returns a dict mapping each value to its document, or to None if no
+        document has that value. Uses one $in query per `chunk_size` values.'''
+        return _find_by_values(self, name, values, fields, chunk_size)
+
+    @vultan.instrument.operation('find', lambda result: len(result[0]))
+    def _find_page(self, query, index=None, token=None, limit=100, fields=None):
+        '''Returns a page of up to `limit` documents in the order of `index`,
+        one of the declared keys (by default, the "id" key), and a token
+        for the next page, or None if this is the last page.
+
+        Pages resume from the last document's index values with a range
+        predicate rather than a skip, so deep pages cost no more than the
+        first. For that the order must be total and served by the index:
+        `index` must be a unique Key or an Index ending in "id", e.g.
+        Index('age', 'id'). Since `index` is declared, the query itself
+        needn't match a key; an empty query pages the collection. Documents
+        missing an indexed field sort as null; apart from null, each field
+        should hold values of one type.
+        '''
+        index = index or Key('id')
+        if index not in list(self._keys):
+            raise vultan.errors.KeyMatchError(index)
+        if not index.unique and index.names[-1] != 'id':
+            raise vultan.errors.KeyMatchError(
+                '%r can\'t order pages; end it with "id"' % index)
+        sort = [(self._codec.dbname(name), direction)
+                for name, direction in index.index]
+
+        spec = self._query_to_mongo(query)
+        if token:
+            spec = _seek_spec(spec, sort, _decode_page_token(token, sort))
+        fields = self._add_key_fields(fields)
+        vultan.instrument.annotate(sort=sort,
+                                   fields=self._fields_to_mongo(fields))
+        cursor = self._get_collection().find(
+            spec=spec, fields=self._fields_to_mongo(fields), limit=limit + 1,
+            sort=sort, **self._read_options())
+
+        docs = list(cursor)
+        next_token = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_token = _encode_page_token(
+                sort, [docs[-1].get(dbname) for dbname, _ in sort])
+        return [self._construct(doc, fields) for doc in docs], next_token
+
+    @vultan.instrument.operation('count')
     def _count(self, query, require_index=True):
         return self._find_as_cursor(query, require_index=require_index).count()
 
+    @vultan.instrument.operation('insert')
     def _insert(self, doc):
         '''Returns the ObjectId of the inserted document.'''
         for key in self._keys:
             if key.head != 'id':
                 key.match(doc, unique=True)
         doc = self._document_to_mongo(doc)
-        object_id = self._get_collection().insert(doc, safe=True)
+        try:
+            object_id = self._get_collection().insert(doc, safe=True)
+        finally:
+            self._invalidate_cache(doc)
         return str(object_id)
 
+    def _insert_many(self, docs, ordered=True,
+                     chunk_size=vultan.bulk.INSERT_CHUNK_SIZE,
+                     chunk_bytes=vultan.bulk.INSERT_CHUNK_BYTES):
+        '''Inserts an iterable of documents in bounded chunks. Returns a
+        vultan.bulk.InsertResult.'''
+        return vultan.bulk.insert_many(
+            self._get_collection(), docs, self._document_to_mongo,
+            self._keys.unique_names(), ordered, chunk_size, chunk_bytes,
+            self._invalidate_cache_many)
+
+    @vultan.instrument.operation('update')
     def _update(self, query, doc, multi=False):
         '''Updates exactly one document if multi=False. Otherwise, updates
         zero or more documents.'''
         spec = self._query_to_mongo(self._keys.match(query, unique=not multi))
-        result = self._get_collection().update(spec, self._update_to_mongo(doc),
-                                               multi=multi, safe=True)
+        try:
+            result = self._get_collection().update(
+                spec, self._update_to_mongo(doc), multi=multi, safe=True)
+        finally:
+            self._invalidate_cache(spec, multi)
         if not multi and not result['updatedExisting']:
             raise vultan.errors.DocumentNotFoundError(spec)
         return result['n']
 
+    @vultan.instrument.operation('upsert')
     def _upsert(self, query, doc):
         '''Updates one document or inserts it if it doesn't exist.
            Returns True if it updated an existing document. Otherwise
            returns False.'''
         spec = self._query_to_mongo(self._keys.match(query, unique=True))
-        result = self._get_collection().update(spec, self._update_to_mongo(doc),
-                                               multi=False, safe=True, upsert=True)
+        try:
+            result = self._get_collection().update(
+                spec, self._update_to_mongo(doc), multi=False, safe=True,
+                upsert=True)
+        finally:
+            self._invalidate_cache(spec)
         return result['updatedExisting']
 
+    def _bulk_update(self, operations, upsert=False, ordered=True,
+                     batch_size=vultan.bulk.WRITE_BATCH_SIZE):
+        '''Applies an iterable of (query, update) pairs, each of which must
+        match a unique key, in batches of server-side updates. Returns a
+        vultan.bulk.WriteResult.'''
+        def encode(operation):
+            query, doc = operation
+            spec = self._query_to_mongo(self._keys.match(query, unique=True))
+            return spec, self._update_to_mongo(doc)
+        return vultan.bulk.bulk_update(self._get_collection(), operations,
+                                       encode, upsert, ordered, batch_size,
+                                       self._invalidate_cache_many)
+
+    @vultan.instrument.operation('remove')
     def _remove(self, query):
         '''Removes matching documents.'''
         spec = self._query_to_mongo(self._keys.match(query))
-        result = self._get_collection().remove(spec, safe=True)
+        try:
+            result = self._get_collection().remove(spec, safe=True)
+        finally:
+            self._invalidate_cache(spec)
         return result['n']
 
     #
     # private methods
     #
 
-    def _find_as_cursor(self, query, fields=None, skip=0, limit=0, require_index=True):
+    @vultan.instrument.operation('find')
+    def _find_as_cursor(self, query, fields=None, skip=0, limit=0,
+                        require_index=True, sort=None):
         if require_index: self._keys.match(query)
-        return self._get_collection().find(spec=self._query_to_mongo(query),
-                                           fields=self._add_key_fields(fields),
-                                           skip=skip, limit=limit)
+        fields = self._fields_to_mongo(self._add_key_fields(fields))
+        vultan.instrument.annotate(sort=sort, fields=fields)
+        cursor = self._get_collection().find(spec=self._query_to_mongo(query),
+                                             fields=fields, skip=skip,
+                                             limit=limit,
+                                             **self._read_options())
+        return cursor.sort(sort) if sort else cursor
+
+    def _split_by_id(self, spec, count):
+        '''Returns copies of `spec` restricted to consecutive _id ranges that
+        together cover the whole collection.'''
+        collection = self._get_collection()
+        bounds = []
+        for direction in (pymongo.ASCENDING, pymongo.DESCENDING):
+            docs = list(collection.find(spec=spec, fields={'_id': True},
+                                        sort=[('_id', direction)], limit=1,
+                                        **self._read_options()))
+            bounds.append(docs[0]['_id'] if docs else None)
+        lowest, highest = bounds
+        if '_id' in spec or count < 2 or not all(
+                isinstance(bound, pymongo.objectid.ObjectId) for bound in bounds):
+            return [spec]
+
+        start = lowest.generation_time
+        step = (highest.generation_time - start) / count
+        points = vultan.types._unique_list(
+            pymongo.objectid.ObjectId.from_datetime(start + step * i)
+            for i in range(1, count))
+        ranges = []
+        for lower, upper in zip([None] + points, points + [None]):
+            condition = {}
+            if lower is not None:
+                condition['$gte'] = lower
+            if upper is not None:
+                condition['$lt'] = upper
+            range_spec = dict(spec)
+            range_spec['_id'] = condition
+            ranges.append(range_spec)
+        return ranges
+
+    @vultan.instrument.operation('find')
+    def _find_rows(self, query, names, make_row, skip, limit, sort,
+                   require_index, batch_size, hint=None):
+        if require_index:
+            self._keys.match(query)
+        fields = self._codec.projection(names)
+        vultan.instrument.annotate(sort=sort, fields=fields)
+        cursor = self._get_collection().find(
+            spec=self._query_to_mongo(query), fields=fields, skip=skip,
+            limit=limit, **self._read_options())
+        if sort:
+            cursor.sort(sort)
+        if hint:
+            cursor.hint(hint)
+        if batch_size:
+            cursor.batch_size(batch_size)
+        return _DocumentCursor(cursor, make_row)
+
+    def _row_maker(self, names):
+        '''Returns a function that decodes the `names` attributes of a
+        mongodb document into a tuple.'''
+        columns = [(self._codec.dbname(name), self._codec.decoder(name))
+                   for name in names]
+        return lambda doc: tuple(decode(doc.get(dbname))
+                                 for dbname, decode in columns)
+
+    def _is_multikey(self, name):
+        return isinstance(self._attributes.get_fieldtype(name),
+                          (vultan.types.ListField, vultan.types.TupleField))
+
+    def _get_cache_key(self, spec, fields):
+        '''Returns a cache key for an equality-only spec, or None if the
+        spec can't be cached (or caching is disabled).'''
+        if self._cache is None:
+            return None
+        for value in spec.itervalues():
+            if isinstance(value, dict) or not vultan.cache.hashable(value):
+                return None
+        return (tuple(sorted(spec.iteritems())),
+                tuple(sorted(fields)) if fields else None)
+
+    def _get_cache_pairs(self, doc):
+        '''Returns the (dbname, value) pairs of a mongodb document's keys.'''
+        return [(dbname, value) for dbname, value in doc.iteritems()
+                if dbname in self._key_dbnames and vultan.cache.hashable(value)]
+
+    def _invalidate_cache(self, spec, multi=False):
+        '''Drops cached documents a write to `spec` may have touched. When
+        that can't be narrowed down by key values, drops everything.'''
+        if self._cache is None:
+            return
+        pairs = [] if multi else [pair for pair in self._get_cache_pairs(spec)
+                                  if not isinstance(pair[1], dict)]
+        if pairs:
+            self._cache.invalidate(pairs)
+        else:
+            self._cache.clear()
+
+    def _invalidate_cache_many(self, specs):
+        for spec in specs:
+            self._invalidate_cache(spec)
+
+    def _fields_to_mongo(self, fields):
+        if not fields: return None
+        return [self._codec.dbname(name) for name in fields]
 
     def _add_key_fields(self, fields):
         if not fields: return None
         return list(set(fields).union(self._keys.names))
 
+    @vultan.instrument.phase('encode')
     def _document_to_mongo(self, doc):
-        return self._to_mongo(doc, 'AUTO')
+        return self._codec.encode(doc, 'AUTO')
 
+    @vultan.instrument.phase('encode')
     def _query_to_mongo(self, doc):
-        def helper(fieldtype, value):
-            if isinstance(value, dict):
-                if all(key.startswith('$') for key in value):
-                    dct = {}
-                    for op, val in value.iteritems():
-                        if op in ['$gt', '$lt', '$gte', '$lte', '$ne']:
-                            dct[op] = fieldtype.to_mongo(val, 'AUTO')
-                        elif op in ['$in', '$nin']:
-                            dct[op] = fieldtype.to_mongo(val, 'MANY')
-                        else:
-                            raise vultan.errors.UnsupportedMongodbOpError(op)
-                    return dct
-            return fieldtype.to_mongo(value, 'NONE')
-
-        answer = {}
-        for key, value in doc.iteritems():
-            fieldtype = self._get_fieldtype(key)
-            answer[fieldtype.get_dbname(key)] = helper(fieldtype, value)
-        return answer
+        return self._codec.encode_query(doc)
 
+    @vultan.instrument.phase('encode')
     def _update_to_mongo(self, doc):
-        answer = {}
-        for key, value in doc.iteritems():
-            if key.startswith('$'):
-                if key in ['$set', '$unset']:
-                    answer[key] = self._to_mongo(value, 'AUTO')
-                elif key in ['$push', '$pull']:
-                    answer[key] = self._to_mongo(value, 'ATOM')
-                elif key in ['$pushAll', '$pullAll']:
-                    answer[key] = self._to_mongo(value, 'LIST')
-                elif key in ['$inc', '$pop']:
-                    answer[key] = self._to_mongo(value, dotransform=False)
-                else:
-                    raise vultan.errors.UnsupportedMongodbOpError(key)
-            else:
-                fieldtype = self._get_fieldtype(key)
-                value = fieldtype.to_mongo(value, 'AUTO')
-                answer[fieldtype.get_dbname(key)] = value
-        return answer
+        return self._codec.encode_update(doc)
 
     def _to_mongo(self, doc, context='AUTO', dotransform=True):
-        answer = {}
-        for key, value in doc.iteritems():
-            fieldtype = self._get_fieldtype(key)
-            if dotransform:
-                value = fieldtype.to_mongo(value, context)
-            answer[fieldtype.get_dbname(key)] = value
-        return answer
+        if not dotransform:
+            return self._codec.rename(doc)
+        return self._codec.encode(doc, context)
 
     def _get_fieldtype(self, name):
         fieldtype = self._attributes.get_fieldtype(name)
@@ -187,18 +525,50 @@ class SimpleStorage(Storage):
     def find(self, **kwargs):
         return self._find(kwargs)
 
+    def iterfind(self, **kwargs):
+        return self._iterfind(kwargs)
+
+    def find_many(self, name, values):
+        return self._find_many(name, values)
+
+    def find_page(self, query, index=None, token=None, limit=100):
+        return self._find_page(query, index, token, limit)
+
+    # The leading underscores keep these parameters from colliding with
+    # query attributes, e.g. values('age', name=u'n2').
+    def values_list(self, _names, **kwargs):
+        return self._values_list(kwargs, _names)
+
+    def values(self, _name, **kwargs):
+        return self._values(kwargs, _name)
+
+    def find_covered(self, _names, **kwargs):
+        return list(self._find_covered(kwargs, _names))
+
     def exists(self, **kwargs):
         return self._exists(kwargs)
 
+    def exists_many(self, name, values):
+        return self._exists_many(name, values)
+
     def count(self, **kwargs):
         return self._count(kwargs)
 
     def insert(self, **kwargs):
         return self._insert(kwargs)
 
+    def insert_many(self, docs, ordered=True):
+        return self._insert_many(docs, ordered)
+
     def upsert(self, query, **kwargs):
         return self._upsert(query, kwargs)
 
+    def bulk_upsert(self, operations, ordered=True):
+        return self._bulk_update(operations, upsert=True, ordered=ordered)
+
+    def bulk_update(self, operations, ordered=True):
+        return self._bulk_update(operations, upsert=False, ordered=ordered)
+
     def update_one(self, query, **kwargs):
         return self._update(query, kwargs, multi=False)
 
@@ -215,6 +585,161 @@ class SimpleStorage(Storage):
         return self._remove(kwargs)
 
 
+def _scan_range(task):
+    '''Runs in a parallel_scan worker: decodes (and maps) the next chunk of
+    documents matching one range spec, after the _id `after` if given.
+    Returns them with the task that continues the range, or None once it
+    is done. With a reducer, reduces the whole range in one task.'''
+    (storage_class, document_class, spec, after, fields, mapper, reducer,
+     chunk_size) = task
+    storage = storage_class(document_class)
+    if after is not None:
+        spec = {'$and': [spec, {'_id': {'$gt': after}}]}
+    find = functools.partial(
+        storage._get_collection().find, spec=spec,
+        fields=storage._fields_to_mongo(storage._add_key_fields(fields)),
+        **storage._read_options())
+    if reducer:
+        values = (storage._construct(doc, fields) for doc in find())
+        if mapper:
+            values = itertools.imap(mapper, values)
+        value = _reduce_or_none(reducer, values)
+        return ([value] if value is not None else []), None
+    docs = list(find(sort=[('_id', pymongo.ASCENDING)], limit=chunk_size))
+    values = [storage._construct(doc, fields) for doc in docs]
+    if mapper:
+        values = map(mapper, values)
+    if len(docs) < chunk_size:
+        return values, None
+    return values, (storage_class, document_class, task[2], docs[-1]['_id'],
+                    fields, mapper, reducer, chunk_size)
+
+
+def _reduce_or_none(reducer, values):
+    values = iter(values)
+    try:
+        first = values.next()
+    except StopIteration:
+        return None
+    return reduce(reducer, values, first)
+
+
+def _encode_page_token(sort, values):
+    data = bson.BSON.encode({'sort': [list(pair) for pair in sort],
+                             'values': values})
+    return base64.urlsafe_b64encode(data)
+
+
+def _decode_page_token(token, sort):
+    try:
+        data = bson.BSON(base64.urlsafe_b64decode(str(token))).decode()
+    except Exception:
+        raise vultan.errors.InvalidPageTokenError(token)
+    if data.get('sort') != [list(pair) for pair in sort]:
+        raise vultan.errors.InvalidPageTokenError(token)
+    return data['values']
+
+
+def _seek_spec(spec, sort, values):
+    '''Restricts `spec` to the documents that sort after `values`. Adds a
+    bound on the first sort field the query doesn't pin to one value, so
+    that the index scan starts at the seek position.'''
+    answer = dict(spec)
+    clauses = _seek_clauses(sort, values)
+    if '$or' in answer:
+        answer = {'$and': [answer, {'$or': clauses}]}
+    else:
+        answer['$or'] = clauses
+    for (dbname, direction), value in zip(sort, values):
+        if dbname not in spec:
+            bound = _seek_bound(direction, value)
+            if bound is not None:
+                answer[dbname] = bound
+            break
+        if isinstance(spec[dbname], dict) or spec[dbname] != value:
+            break
+    return answer
+
+
+def _seek_clauses(sort, values):
+    '''Builds the $or clauses selecting documents that sort after `values`:
+    (a > va) or (a == va and b > vb) or ... for ascending fields.'''
+    clauses = []
+    for i, (dbname, direction) in enumerate(sort):
+        prefix = dict((name, value) for (name, _), value
+                      in zip(sort[:i], values[:i]))
+        for condition in _after(direction, values[i]):
+            clause = dict(prefix)
+            clause[dbname] = condition
+            clauses.append(clause)
+    return clauses
+
+
+def _after(direction, value):
+    '''Returns conditions that together match the values that sort after
+    `value`. Null (or missing) sorts before every other value, and {$gt:
+    null} matches nothing, so null needs conditions of its own.'''
+    if direction == pymongo.ASCENDING:
+        return [{'$ne': None}] if value is None else [{'$gt': value}]
+    return [] if value is None else [{'$lt': value}, None]
+
+
+def _seek_bound(direction, value):
+    '''Returns a condition on the first sort field that every document
+    after `value` meets, or None if there is no useful one.'''
+    if direction == pymongo.ASCENDING:
+        return None if value is None else {'$gte': value}
+    return None if value is None else {'$not': {'$gt': value}}
+
+
+def prefetch(documents, *names):
+    '''Resolves the references held in attributes `names` for a batch of
+    documents, using one query per referenced document class.
+
+    Each attribute must be an ObjectId field declared with references().
+    The referenced document is attached as `<name>_doc` (None if it does not
+    exist); for list and set fields, the list of existing referenced
+    documents is attached as `<name>_docs`. Documents where the attribute
+    was not loaded are skipped. Slotted document classes reserve slots for
+    both names.
+    '''
+    wanted = collections.defaultdict(set)
+    plan = []
+    for document in documents:
+        for name in names:
+            target = _get_reference_target(document, name)
+            try:
+                value = getattr(document, name)
+            except vultan.errors.MissingAttributeError:
+                continue
+            ids = value if isinstance(value, list) else [value]
+            wanted[target].update(ref for ref in ids if ref)
+            plan.append((document, name, target, value))
+
+    found = {}
+    for target, ids in wanted.iteritems():
+        storage = getattr(target, 'DB', target)
+        found[target] = storage._find_many('id', list(ids))
+
+    for document, name, target, value in plan:
+        related = found.get(target, {})
+        if isinstance(value, list):
+            docs = [related[ref] for ref in value if related.get(ref)]
+            setattr(document, name + '_docs', docs)
+        else:
+            setattr(document, name + '_doc', related.get(value))
+
+
+def _get_reference_target(document, name):
+    fieldtype = document._attributes.get_fieldtype(name)
+    if not fieldtype:
+        raise vultan.errors.UnrecognizedAttributeError(name)
+    target = fieldtype.get_references()
+    if not target:
+        raise vultan.errors.UndeclaredReferenceError(name)
+    return target
+
+
 class _NewDocumentMetaclass(type):
     def __new__(meta, classname, bases, classdict):
         # Inherit keys from our bases
@@ -222,6 +747,7 @@ class _NewDocumentMetaclass(type):
         for base in bases:
             if hasattr(base, '_keys'):
                 keys.update(base._keys)
+        keys.plan_declared_shapes()
         classdict['_keys'] = keys
 
         # Inherit attributes from our bases
@@ -230,6 +756,7 @@ class _NewDocumentMetaclass(type):
             if hasattr(base, '_attributes'):
                 attrs.update(base._attributes)
         classdict['_attributes'] = attrs
+        classdict['_codec'] = _Codec(attrs)
 
         # Inherit storage from bases unless we have our own
         storage = classdict.get('_storage', classdict.get('_Storage'))
@@ -239,42 +766,115 @@ class _NewDocumentMetaclass(type):
                     storage = base._storage
                     break
 
+        _add_slots(classdict, bases, attrs)
+
         newtype = type.__new__(meta, classname, bases, classdict)
+        _install_lazy_fields(newtype)
         newtype.DB = (storage or SimpleStorage)(newtype)
         return newtype
 
 
 class NewDocument(object):
     __metaclass__ = _NewDocumentMetaclass
+    __slots__ = ()
+    _connection = vultan.connection.DEFAULT_ALIAS
+    _read_preference = None
+    _lazy = False
+    _slots = False
+    _keep_data = True
 
     def __init__(self, data, expected):
         self._data = data
         self._expected = expected
         self._missing = []
-        for name, fieldtype in self._attributes:
-            self._extract(name, fieldtype)
+        for name, dbname, decode in self._codec.decoders:
+            self._extract(name, dbname, decode)
+        if not self._keep_data:
+            self._data = None
 
     def __getattr__(self, name):
-        if name in self._missing:
+        if name in _get_missing(self):
             raise vultan.errors.MissingAttributeError(name)
         raise AttributeError(name)
 
     def __repr__(self):
-        data = self.__dict__.copy()
-        for k in data.keys():
-            if k.startswith('_'):
-                del data[k]
+        data = dict((name, getattr(self, name)) for name, _ in self._attributes
+                    if name not in self._missing)
         return '%s(%s)' % (self.__class__.__name__, data)
 
+    def save(self):
+        '''Writes back the attributes that changed since the document was
+        loaded, as a minimal $set/$unset/$push update. Returns False if
+        nothing changed, in which case no request is made.'''
+        if not getattr(self, 'id', None):
+            raise vultan.errors.DocumentNotFoundError(self)
+        assert self._data is not None, 'save() needs _keep_data = True'
+        update, encoded = self._changes()
+        if not update:
+            return False
+        self.DB._update({'id': self.id}, update)
+        for dbname, value in encoded.iteritems():
+            if value is None:
+                self._data.pop(dbname, None)
+            else:
+                self._data[dbname] = value
+        return True
+
     #
     # private methods
     #
 
-    def _extract(self, name, fieldtype):
+    def _changes(self):
+        '''Compares loaded attributes with the raw data they were decoded
+        from. Returns the update (in attribute names) and the new encoded
+        values by dbname.'''
+        update = collections.defaultdict(dict)
+        encoded = {}
+        for name, dbname, decode in self._codec.decoders:
+            if name == 'id':
+                continue
+            try:
+                value = _peek(self, name)
+            except AttributeError:
+                continue  # never loaded, or never decoded (lazy)
+            if value is None:
+                # Several fields can't encode None; it means "unset".
+                if self._data.get(dbname) is not None:
+                    encoded[dbname] = None
+                    update['$unset'][name] = 1
+                continue
+            encode = self._codec.encoder(name)
+            new = encode(value)
+            old = self._data.get(dbname)
+            if new == old or new == encode(decode(old)):
+                continue
+            encoded[dbname] = new
+            if new is None:
+                update['$unset'][name] = 1
+            elif self._is_append(name, value, new, old):
+                appended = value[len(old):]
+                if len(appended) == 1:
+                    update['$push'][name] = appended[0]
+                else:
+                    update['$pushAll'][name] = appended
+            else:
+                update['$set'][name] = value
+        return dict(update), encoded
+
+    def _is_append(self, name, value, new, old):
+        '''True if the list attribute `name` only gained items at its end.'''
+        return (isinstance(self._attributes.get_fieldtype(name),
+                           vultan.types.ListField)
+                and isinstance(value, list) and isinstance(old, list)
+                and len(new) == len(value) and len(new) > len(old)
+                and new[:len(old)] == old)
+
+    def _extract(self, name, dbname, decode):
         if not self._keys.contains(name):
             if self._expected and name not in self._expected:
                 self._missing.append(name)
                 return
+        if self._lazy:
+            return  # decoded on first access by _LazyField
 
-        value = self._data.get(fieldtype.get_dbname(name))
-        setattr(self, name, fieldtype.from_mongo(value))
+        setattr(self, name, decode(self._data.get(dbname)))
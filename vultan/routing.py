@@ -0,0 +1,166 @@
+"""Routes reads to replica-set secondaries.
+
+A document class or storage declares where its reads may go:
+
+    class PostStorage(SimpleStorage):
+        _read_preference = vultan.routing.ReadPreference(
+            vultan.routing.SECONDARY_PREFERRED, max_staleness=30)
+
+Reads (finds, counts, existence checks) then carry the matching pymongo
+read preference; writes always go to the primary. Register the alias with
+a `replicaSet` option so that it connects with pymongo's
+ReplicaSetConnection, which is what spreads reads over the secondaries.
+
+With `max_staleness` (in seconds), reads fall back to the primary while
+any secondary lags the primary by more than that, or while the lag can't
+be determined; pymongo picks the secondary, so every one must be fresh
+enough. Lag comes from each alias's topology: by default a
+ReplicaSetTopology, which polls replSetGetStatus. Tests can install a
+StubTopology with set_topology().
+"""
+import threading
+import time
+import pymongo
+import pymongo.errors
+import vultan.connection
+import vultan.errors
+
+PRIMARY = 'primary'
+SECONDARY_PREFERRED = 'secondary_preferred'
+NEAREST = 'nearest'
+
+# pymongo 2.1 has no "nearest"; SECONDARY (a secondary if one is up, else
+# the primary) is the closest it offers.
+_PYMONGO_MODES = {
+    PRIMARY: pymongo.ReadPreference.PRIMARY,
+    SECONDARY_PREFERRED: pymongo.ReadPreference.SECONDARY,
+    NEAREST: getattr(pymongo.ReadPreference, 'NEAREST',
+                     pymongo.ReadPreference.SECONDARY),
+}
+
+DEFAULT_REFRESH_INTERVAL = 5.0
+
+_lock = threading.Lock()
+_topologies = {}
+
+
+class ReadPreference(object):
+    def __init__(self, mode=PRIMARY, max_staleness=None):
+        if mode not in _PYMONGO_MODES:
+            raise vultan.errors.InvalidReadPreferenceError(mode)
+        self.mode = mode
+        self.max_staleness = max_staleness
+
+    def __repr__(self):
+        return '%s(%r, max_staleness=%r)' % (self.__class__.__name__,
+                                             self.mode, self.max_staleness)
+
+
+class ReplicaSetTopology(object):
+    """Reports how far an alias's secondaries lag its primary, refreshing
+    from replSetGetStatus at most every `refresh_interval` seconds."""
+    def __init__(self, alias, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 clock=time.time):
+        self._alias = alias
+        self._refresh_interval = refresh_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._lag = None
+        self._expires = None
+        self._refreshing = False
+
+    def secondary_lag(self):
+        """Returns the largest lag of a healthy secondary in seconds, or
+        None if there is no primary or secondary or the status is
+        unavailable.
+
+        One caller at a time refreshes, outside the lock; the others get
+        the previous answer meanwhile rather than waiting on the server."""
+        with self._lock:
+            now = self._clock()
+            if self._refreshing or \
+                    (self._expires is not None and now < self._expires):
+                return self._lag
+            self._refreshing = True
+        try:
+            lag = self._fetch_lag()
+        except:
+            with self._lock:
+                self._refreshing = False
+            raise
+        with self._lock:
+            self._lag = lag
+            self._expires = now + self._refresh_interval
+            self._refreshing = False
+        return lag
+
+    def _fetch_lag(self):
+        try:
+            connection = vultan.connection.get_connection(self._alias)
+            status = connection.admin.command('replSetGetStatus')
+        except pymongo.errors.PyMongoError:
+            return None
+        return _lag_from_status(status)
+
+
+class StubTopology(object):
+    """A topology whose lag is whatever the test sets."""
+    def __init__(self, lag=None):
+        self.lag = lag
+
+    def secondary_lag(self):
+        return self.lag
+
+
+def get_topology(alias):
+    with _lock:
+        topology = _topologies.get(alias)
+        if topology is None:
+            topology = _topologies[alias] = ReplicaSetTopology(alias)
+        return topology
+
+
+def set_topology(alias, topology):
+    """Installs `topology` for `alias`; None restores the default."""
+    with _lock:
+        if topology is None:
+            _topologies.pop(alias, None)
+        else:
+            _topologies[alias] = topology
+
+
+def resolve(preference, alias):
+    """Returns the pymongo read preference for a read under `preference`
+    (a ReadPreference, a mode name or None) on `alias`."""
+    if preference is None:
+        return pymongo.ReadPreference.PRIMARY
+    if isinstance(preference, basestring):
+        preference = ReadPreference(preference)
+    if preference.mode == PRIMARY:
+        return pymongo.ReadPreference.PRIMARY
+    if preference.max_staleness is not None:
+        lag = get_topology(alias).secondary_lag()
+        if lag is None or lag > preference.max_staleness:
+            return pymongo.ReadPreference.PRIMARY
+    return _PYMONGO_MODES[preference.mode]
+
+
+def read_options(preference, alias):
+    """Returns the keyword arguments that route a find() per `preference`."""
+    if preference is None:
+        return {}
+    return {'read_preference': resolve(preference, alias)}
+
+
+def _lag_from_status(status):
+    members = status.get('members', [])
+    primaries = [member['optimeDate'] for member in members
+                 if member.get('stateStr') == 'PRIMARY']
+    secondaries = [member['optimeDate'] for member in members
+                   if member.get('stateStr') == 'SECONDARY' and
+                   member.get('health', 1)]
+    if not primaries or not secondaries:
+        return None
+    lag = primaries[0] - min(secondaries)
+    return max(0.0, lag.days * 86400 + lag.seconds +
+               lag.microseconds / 1e6)
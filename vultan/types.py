@@ -11,6 +11,17 @@ def _unique_list(seq):
     return [item for item in seq if item not in seen and not add(item)]
 
 
+def _overrides(field, cls, name):
+    """True if `field`'s class replaces the `name` method defined on `cls`."""
+    return getattr(type(field), name).im_func is not getattr(cls, name).im_func
+
+
+def _raiser(exception):
+    def encode(value):
+        raise exception
+    return encode
+
+
 class Field(object):
     def __init__(self, default=None):
         self._default = default
@@ -22,6 +33,18 @@ class Field(object):
     def get_dbname(self, name):
         return self._dbname if hasattr(self, '_dbname') else name
 
+    def references(self, document_class):
+        """Declares the document class whose ids this field holds. Pass a
+        function returning the class to refer to one not yet defined."""
+        self._references = document_class
+        return self
+
+    def get_references(self):
+        target = getattr(self, '_references', None)
+        if target is None or isinstance(target, type):
+            return target
+        return target()
+
     def from_mongo(self, value):
         try:
             return self.do_from_mongo(value)
@@ -49,6 +72,20 @@ class Field(object):
             raise vultan.errors.ScalarUsedInVectorTransformContextError
         raise vultan.errors.InvalidTransformContextError(context)
 
+    def encoder(self, context='AUTO'):
+        """Returns a one-argument callable equivalent to to_mongo(value,
+        context), with the dispatch on `context` resolved ahead of time."""
+        if _overrides(self, Field, 'to_mongo'):
+            return lambda value: self.to_mongo(value, context)
+        if context == 'AUTO' or context == 'NONE':
+            return self.do_to_mongo
+        if context == 'MANY':
+            do_to_mongo = self.do_to_mongo
+            return lambda value: [do_to_mongo(item) for item in value]
+        if context in ['ATOM', 'LIST']:
+            return _raiser(vultan.errors.ScalarUsedInVectorTransformContextError)
+        raise vultan.errors.InvalidTransformContextError(context)
+
     def do_to_mongo(self, value):
         """Marshals a Python value into a format appropriate for mongodb.
 
@@ -96,6 +133,7 @@ class TupleField(Field):
 class ListField(Field):
     def __init__(self, subfield):
         self._subfield = subfield
+        self._subencoder = subfield.encoder('AUTO')
 
     def do_from_mongo(self, value):
         try:
@@ -115,11 +153,26 @@ class ListField(Field):
             return self._subfield.to_mongo(value)
         raise vultan.errors.InvalidTransformContextError(context)
 
+    def encoder(self, context='AUTO'):
+        if _overrides(self, ListField, 'to_mongo'):
+            return lambda value: self.to_mongo(value, context)
+        if context in ['LIST', 'MANY']:
+            return self.do_to_mongo
+        if context == 'ATOM':
+            return self._subencoder
+        if context in ['AUTO', 'NONE']:
+            do_to_mongo = self.do_to_mongo
+            subencoder = self._subencoder
+            return lambda value: (do_to_mongo(value) if isinstance(value, list)
+                                  else subencoder(value))
+        raise vultan.errors.InvalidTransformContextError(context)
+
     def do_to_mongo(self, value):
         if not value:
             return []
-        items = [self._subfield.to_mongo(item) for item in value]
-        return filter(lambda x: x != None, items)
+        encode = self._subencoder
+        items = [encode(item) for item in value]
+        return [item for item in items if item != None]
 
 
 class SetField(ListField):